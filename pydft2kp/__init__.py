@@ -2,8 +2,13 @@
 from .irrepwrapper import irrep
 from .qsymmwrapper import qsymm, inversion, rotation, mirror, time_reversal, PointGroupElement
 from .rotatebasis import basis_transform
-from .lowdin import getHpowers, H_of_k
+from .lowdin import getHpowers, H_of_k, fold_down, H_of_fields
+from .cache import fold_down_cache
+from .derivatives import band_derivatives, band_velocities, inverse_mass_tensor
+from .mesh import kmesh, kwedge, evaluate_mesh, load_mesh
+from .spectra import dos, jdos
+from .geometry import quantum_geometry, berry_curvature, chern_number
 from .constants import Ry, a0, hbar
 from .util import convert_units_coeffs
-from .qe_aux import qe_plotter
+from .qe_aux import qe_plotter, partial_spectrum
 from .__version import __version__
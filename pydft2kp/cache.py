@@ -0,0 +1,269 @@
+'''
+Doc for the **pydft2kp/cache.py** module.
+
+The class **fold_down_cache** stores the results of the fold-down on disk,
+so that repeated runs with the same DFT data return instantly. The class
+**checkpoint** stores the completed parts of a long run, so that it can be
+resumed if it is interrupted.
+'''
+
+import os
+import hashlib
+import numpy as np
+from .__version import __version__
+
+class fold_down_cache():
+    '''
+    Content-addressed cache that stores the fold-down results
+    (each order of irrep.Hdict) as compressed npz files.
+
+    Each entry is identified by a hash of all inputs of the fold-down:
+    energies, p matrices, set A, NB and the order. Repeated runs with the
+    same inputs load the stored orders instead of recalculating them. When
+    the total size of the cache exceeds maxsize, the least recently used
+    entries are removed.
+
+    Parameters
+    ----------
+    cachedir : str, optional
+        Directory where the entries are stored. Defaults to the environment
+        variable DFT2KP_CACHE, or to ~/.cache/dft2kp if it is not set.
+    maxsize : int, optional
+        Maximum total size of the cache in bytes. Defaults to 1 GB.
+
+    Attributes
+    ----------
+    cachedir : str
+        Directory where the entries are stored.
+    maxsize : int
+        Maximum total size of the cache in bytes.
+
+    Examples
+    --------
+    >>> cache = fold_down_cache('my_cache_dir', maxsize=200e6)
+    >>> kp.define_set_A(setA, NB=NB, maxorder=3, cache=cache)
+    '''
+    def __init__(self, cachedir=None, maxsize=1e9):
+        if cachedir is None:
+            cachedir = os.environ.get('DFT2KP_CACHE',
+                            os.path.join(os.path.expanduser('~'), '.cache', 'dft2kp'))
+        self.cachedir = cachedir
+        self.maxsize = maxsize
+        os.makedirs(self.cachedir, exist_ok=True)
+
+    def key(self, *inputs):
+        '''
+        Builds the hash that identifies a set of inputs.
+
+        Parameters
+        ----------
+        inputs : arrays, lists, numbers or None
+            All inputs that define the result, e.g. energies, px, py, pz,
+            setA, NB and the order.
+
+        Returns
+        -------
+        str
+            The sha256 hash of the inputs and of the package version.
+        '''
+        return hash_inputs(*inputs)
+
+    def path(self, key):
+        '''
+        Returns the path of the npz file of an entry.
+        '''
+        return os.path.join(self.cachedir, key + '.npz')
+
+    def load(self, key):
+        '''
+        Loads an entry from the cache.
+
+        Parameters
+        ----------
+        key : str
+            Hash built by key(...).
+
+        Returns
+        -------
+        dict or None
+            The stored dictionary, or None if the entry is not found.
+        '''
+        path = self.path(key)
+        if not os.path.isfile(path):
+            return None
+        with np.load(path) as data:
+            h = {decode_key(k): data[k] for k in data.files}
+        # mark as recently used
+        os.utime(path)
+        return h
+
+    def store(self, key, h):
+        '''
+        Stores a dictionary in the cache and evicts old entries if needed.
+
+        Parameters
+        ----------
+        key : str
+            Hash built by key(...).
+        h : dict
+            Dictionary of arrays, e.g. irrep.Hdict.
+        '''
+        path = self.path(key)
+        # write to a temporary file first, so that an interrupted
+        # run never leaves a broken entry behind
+        tmp = path[:-4] + '.tmp.npz'
+        np.savez_compressed(tmp, **{encode_key(k): np.asarray(v) for k, v in h.items()})
+        os.replace(tmp, path)
+        self.evict(keep=path)
+
+    def entries(self):
+        '''
+        Lists the entries of the cache.
+
+        Returns
+        -------
+        list
+            Tuples (last use time, size in bytes, path), ordered from
+            the least to the most recently used.
+        '''
+        entries = []
+        for name in os.listdir(self.cachedir):
+            if name.endswith('.npz') and not name.endswith('.tmp.npz'):
+                path = os.path.join(self.cachedir, name)
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return sorted(entries)
+
+    def evict(self, keep=None):
+        '''
+        Removes the least recently used entries until the total
+        size of the cache is below maxsize.
+
+        Parameters
+        ----------
+        keep : str, optional
+            Path of an entry that is never removed, e.g. the one just
+            stored, even if it alone exceeds maxsize.
+        '''
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.maxsize:
+                break
+            if path == keep:
+                continue
+            os.remove(path)
+            total -= size
+
+    def clear(self):
+        '''
+        Removes all entries of the cache.
+        '''
+        for _, _, path in self.entries():
+            os.remove(path)
+
+
+class checkpoint():
+    '''
+    Single npz file with the completed units of work of a long run,
+    e.g. the orders of the fold-down or the best U of basis_transform.
+
+    The file is rewritten (atomically) each time a unit of work finishes,
+    together with a hash of the inputs of the run. Re-running with the same
+    inputs resumes from the stored units, while a run with other inputs
+    ignores and overwrites the file.
+
+    Parameters
+    ----------
+    path : str
+        Path of the npz file. The extension .npz is added if missing.
+
+    Examples
+    --------
+    >>> kp.define_set_A(setA, NB=NB, maxorder=4, checkpoint='fold_down.npz')
+    >>> optimal = dft2kp.basis_transform(qs, kp, checkpoint='U.npz')
+    '''
+    def __init__(self, path):
+        if not path.endswith('.npz'):
+            path += '.npz'
+        self.path = path
+
+    def load(self, key):
+        '''
+        Loads the stored units of work.
+
+        Parameters
+        ----------
+        key : str
+            Hash of the inputs, built by hash_inputs(...).
+
+        Returns
+        -------
+        dict or None
+            The stored dictionary, or None if the file is not found
+            or if it belongs to a run with other inputs.
+        '''
+        if not os.path.isfile(self.path):
+            return None
+        with np.load(self.path) as data:
+            if '__key__' not in data.files or str(data['__key__']) != key:
+                return None
+            return {decode_key(k): data[k] for k in data.files if k != '__key__'}
+
+    def store(self, key, data):
+        '''
+        Stores the units of work completed so far.
+
+        Parameters
+        ----------
+        key : str
+            Hash of the inputs, built by hash_inputs(...).
+        data : dict
+            Dictionary of arrays.
+        '''
+        tmp = self.path[:-4] + '.tmp.npz'
+        np.savez(tmp, __key__=key, **{encode_key(k): np.asarray(v) for k, v in data.items()})
+        os.replace(tmp, self.path)
+
+    def remove(self):
+        '''
+        Removes the checkpoint file.
+        '''
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+
+def as_checkpoint(checkpoint_or_path):
+    '''
+    Converts a path into a checkpoint, keeping None and checkpoints as they are.
+    '''
+    if checkpoint_or_path is None or isinstance(checkpoint_or_path, checkpoint):
+        return checkpoint_or_path
+    return checkpoint(checkpoint_or_path)
+
+def hash_inputs(*inputs):
+    '''
+    Builds the sha256 hash of a set of inputs (arrays, lists, numbers,
+    strings or None) and of the package version.
+    '''
+    sha = hashlib.sha256(__version__.encode())
+    for x in inputs:
+        if x is None or np.isscalar(x) or isinstance(x, (str, tuple)):
+            sha.update(repr(x).encode())
+        else:
+            x = np.ascontiguousarray(x)
+            sha.update(str((x.shape, x.dtype.str)).encode())
+            sha.update(x.tobytes())
+    return sha.hexdigest()
+
+def encode_key(key):
+    '''
+    Converts a key of Hdict into a valid npz name (0 -> '0').
+    '''
+    return str(key)
+
+def decode_key(name):
+    '''
+    Converts an npz name back into a key of Hdict ('0' -> 0).
+    '''
+    return int(name) if name.isdigit() else name
@@ -26,17 +26,19 @@ sz = array([[1,0],[0,-1]])   #: Pauli matrix, :math:`\sigma_z`
 #                 kx**2 = kx*kx (sympy simplifies it)
 
 strKs = ['k_x', 'k_y', 'k_z']
-#: List of strings labeling the dict keys to read the QSymm families up to order 3.
+#: List of strings labeling the dict keys to read the QSymm families up to order 4.
 QSkeys = []
 QSkeys += [1] # order 0
 QSkeys += strKs # order 1
 QSkeys += [strKs[i]+'*'+strKs[j] for i in range(3) for j in range(i,3)] # order 2
 QSkeys += [strKs[i]+'*'+strKs[j]+'*'+strKs[l] for i in range(3) for j in range(i,3) for l in range(j,3)] # order 3
+QSkeys += [strKs[i]+'*'+strKs[j]+'*'+strKs[l]+'*'+strKs[m] for i in range(3) for j in range(i,3) for l in range(j,3) for m in range(l,3)] # order 4
 
 strKs = ['x', 'y', 'z']
-#: List of strings labeling the dict keys to read the QE data up to order 3.
+#: List of strings labeling the dict keys to read the QE data up to order 4.
 DFTkeys = []
 DFTkeys += [0]
 DFTkeys += strKs
 DFTkeys += [strKs[i]+strKs[j] for i in range(3) for j in range(i,3)]
-DFTkeys += [strKs[i]+strKs[j]+strKs[l] for i in range(3) for j in range(i,3) for l in range(j,3)]
\ No newline at end of file
+DFTkeys += [strKs[i]+strKs[j]+strKs[l] for i in range(3) for j in range(i,3) for l in range(j,3)]
+DFTkeys += [strKs[i]+strKs[j]+strKs[l]+strKs[m] for i in range(3) for j in range(i,3) for l in range(j,3) for m in range(l,3)]
\ No newline at end of file
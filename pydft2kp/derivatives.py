@@ -0,0 +1,277 @@
+'''
+Doc for the **pydft2kp/derivatives.py** module.
+
+Band velocities and effective masses from the analytic derivatives of the
+kp models. Both the folded down model (irrep.Hdict) and the optimal model
+(basis_transform) are polynomials in k, so dH/dk and d²H/dk² are exact and
+are evaluated for many k points at once. Degenerate bands are treated by
+degenerate perturbation theory within each multiplet.
+
+Units: Rydberg, with :math:`\\hbar = 1` and :math:`m_0 = 1/2`, as in the
+rest of the code. So the free electron has :math:`E = k^2` and an inverse
+mass tensor equal to the identity.
+'''
+
+import numpy as np
+from .lowdin import monomial_matrix, contract_monomials, active_dims
+
+def polynomial_model(model, maxorder=2):
+    '''
+    Stacks the matrices of a kp model per monomial of k.
+
+    Parameters
+    ----------
+    model : irrep, basis_transform or dict
+        The folded down model of an irrep object (its Hdict), the optimal
+        model of a basis_transform object (its Hmonomials), or a
+        dictionary as irrep.Hdict.
+    maxorder : int, optional
+        Highest power of k taken from Hdict. Ignored for basis_transform,
+        which uses all powers of its qsymm model. Defaults to 2.
+
+    Returns
+    -------
+    keys : list
+        Keys of the monomials, e.g. [0, 'x', 'xx', ...].
+    T : array
+        Matrices that multiply each monomial, shape (nmonomials, N, N).
+    '''
+    if hasattr(model, 'Hmonomials'): # basis_transform
+        return model.monomials, model.Hmonomials
+    Hdict = getattr(model, 'Hdict', model) # irrep or dict
+    dims = set(active_dims(getattr(Hdict, 'dims', None)))
+    keys = [key for key in Hdict if key == 0 or len(key) <= maxorder and set(key) <= dims]
+    return keys, np.array([Hdict[key] for key in keys], dtype=complex)
+
+def monomial_derivatives(k, keys, axes):
+    '''
+    Evaluates the derivatives of the monomials of k for each key.
+
+    Parameters
+    ----------
+    k : array
+        The k points, shape (Nk, 3).
+    keys : list
+        Keys of the monomials, e.g. [0, 'x', 'xx', 'xyz'].
+    axes : tuple of int
+        Directions of the derivative, e.g. (0,) for d/dkx
+        and (0, 1) for d²/dkx dky.
+
+    Returns
+    -------
+    array
+        The (Nk, len(keys)) matrix with the derivatives,
+        e.g. 2*kx for 'xx' and axes=(0,).
+    '''
+    M = np.zeros([len(k), len(keys)])
+    for j, key in enumerate(keys):
+        # exponents (nx, ny, nz), reduced by each derivative
+        e = [0 if key == 0 else key.count(c) for c in 'xyz']
+        factor = 1
+        for a in axes:
+            factor *= e[a]
+            e[a] = max(e[a]-1, 0)
+        if factor != 0:
+            M[:,j] = factor * np.prod(k**np.array(e), axis=1)
+    return M
+
+def derivative_matrices(model, k, maxorder=2):
+    '''
+    Evaluates H(k) and its exact first and second derivatives.
+
+    Parameters
+    ----------
+    model : irrep, basis_transform or dict
+        See polynomial_model(...).
+    k : array
+        The k points, shape (Nk, 3), or a single k point.
+    maxorder : int, optional
+        See polynomial_model(...).
+
+    Returns
+    -------
+    H : array
+        H(k), shape (Nk, N, N).
+    dH : array
+        dH/dk_i, shape (Nk, 3, N, N).
+    d2H : array
+        d²H/dk_i dk_j, shape (Nk, 3, 3, N, N).
+    '''
+    k = np.atleast_2d(np.asarray(k, dtype=float))
+    keys, T = polynomial_model(model, maxorder)
+    H = contract_monomials(monomial_matrix(k, keys), T)
+    dH = np.stack([contract_monomials(monomial_derivatives(k, keys, (i,)), T)
+                   for i in range(3)], axis=1)
+    d2H = np.empty((len(k), 3, 3) + T.shape[1:], dtype=complex)
+    for i in range(3):
+        for j in range(i, 3):
+            d2H[:,i,j] = contract_monomials(monomial_derivatives(k, keys, (i, j)), T)
+            d2H[:,j,i] = d2H[:,i,j]
+    return H, dH, d2H
+
+def band_derivatives(model, k, directions=None, maxorder=2, tol=1e-6, vtol=1e-6):
+    '''
+    Calculates the first and second derivatives of the bands along
+    given directions, with degenerate perturbation theory.
+
+    Parameters
+    ----------
+    model : irrep, basis_transform or dict
+        See polynomial_model(...).
+    k : array
+        The k points, shape (Nk, 3), or a single k point.
+    directions : array, optional
+        Directions of the derivatives, shape (ndir, 3). They are normalized.
+        Defaults to the x, y and z axes.
+    maxorder : int, optional
+        See polynomial_model(...).
+    tol : float, optional
+        Energies (in Ry) closer than tol are treated as degenerate.
+        Defaults to 1e-6.
+    vtol : float, optional
+        Within a degenerate multiplet, velocities (in Ry.Bohr) closer than
+        vtol are treated as equal, see Notes. Defaults to 1e-6.
+
+    Returns
+    -------
+    energies : array
+        Eigenvalues of H(k), shape (Nk, N).
+    velocities : array
+        dE/dq along each direction, shape (Nk, ndir, N).
+    curvatures : array
+        d²E/dq² along each direction, shape (Nk, ndir, N).
+
+    Notes
+    -----
+    For a band n separated from the others,
+
+    .. math::
+        E'' = \\langle n|H''|n\\rangle + 2 \\sum_{m \\neq n} \\frac{|\\langle n|H'|m\\rangle|^2}{E_n - E_m},
+
+    with :math:`H' = \\hat{q} \\cdot \\nabla_k H` and :math:`H''` the second
+    derivative along :math:`\\hat{q}`. For a degenerate multiplet D, the
+    velocities are the eigenvalues of :math:`P_D H' P_D`. Within each group of
+    equal velocities (closer than vtol), the curvatures are the eigenvalues of
+
+    .. math::
+        W = P_D H'' P_D + 2 \\sum_{m \\notin D} \\frac{P_D H'|m\\rangle\\langle m|H' P_D}{E_D - E_m}.
+
+    Within a multiplet the bands are ordered by velocity and then by
+    curvature, so they follow the branches that leave k along each direction.
+    '''
+    H, dH, d2H = derivative_matrices(model, k, maxorder)
+    if directions is None:
+        directions = np.eye(3)
+    q = np.atleast_2d(np.asarray(directions, dtype=float))
+    q = q / np.linalg.norm(q, axis=1)[:,None]
+
+    E, U = np.linalg.eigh(H)
+    Uh = U.conj().swapaxes(-1, -2)
+    # derivatives along each direction, in the eigenbasis of H(k)
+    D1 = Uh[:,None] @ np.einsum('di,kiab->kdab', q, dH) @ U[:,None]
+    D2 = Uh[:,None] @ np.einsum('di,dj,kijab->kdab', q, q, d2H) @ U[:,None]
+
+    # energy denominators, skipping the degenerate pairs
+    dE = E[:,:,None] - E[:,None,:]
+    degenerate = np.abs(dE) < tol
+    inv = np.where(degenerate, 0, 1/np.where(degenerate, 1, dE))
+
+    # non-degenerate formulas for all bands
+    v = np.real(np.diagonal(D1, axis1=-2, axis2=-1)).copy()
+    c = np.real(np.diagonal(D2, axis1=-2, axis2=-1)
+                + 2*np.einsum('kdam,kam->kda', np.abs(D1)**2, inv))
+
+    # degenerate multiplets
+    for n in np.argwhere(degenerate.sum(axis=2).max(axis=1) > 1)[:,0]:
+        for D in multiplets(E[n], tol):
+            if len(D) == 1:
+                continue
+            for d in range(len(q)):
+                V1 = D1[n,d][np.ix_(D,D)]
+                W = D2[n,d][np.ix_(D,D)] + 2*(D1[n,d][D,:]*inv[n,D[0],:]) @ D1[n,d][:,D]
+                vD, R = np.linalg.eigh(V1)
+                cD = np.empty(len(D))
+                for S in multiplets(vD, vtol):
+                    RS = R[:,S]
+                    cD[S] = np.linalg.eigvalsh(RS.conj().T @ W @ RS)
+                order = np.lexsort((cD, vD))
+                v[n,d,D] = vD[order]
+                c[n,d,D] = cD[order]
+    return E, v, c
+
+def band_velocities(model, k, maxorder=2, tol=1e-6, vtol=1e-6):
+    '''
+    Calculates the band velocities dE/dk.
+
+    Parameters
+    ----------
+    model, k, maxorder, tol, vtol :
+        See band_derivatives(...).
+
+    Returns
+    -------
+    array
+        The velocities, shape (Nk, N, 3), in Ry.Bohr (with hbar = 1).
+        Within a degenerate multiplet, each component is calculated by
+        degenerate perturbation theory along its own axis.
+    '''
+    _, v, _ = band_derivatives(model, k, None, maxorder, tol, vtol)
+    return v.swapaxes(1, 2)
+
+def inverse_mass_tensor(model, k, maxorder=2, tol=1e-6, vtol=1e-6):
+    '''
+    Calculates the inverse effective-mass tensors of the bands.
+
+    Parameters
+    ----------
+    model, k, maxorder, tol, vtol :
+        See band_derivatives(...).
+
+    Returns
+    -------
+    array
+        The tensors :math:`m_0 (1/m^*)_{ij} = \\frac{1}{2} \\partial^2 E / \\partial k_i \\partial k_j`,
+        shape (Nk, N, 3, 3). The effective masses (in units of m0) are
+        the inverse, np.linalg.inv(...), of each tensor.
+
+    Notes
+    -----
+    For bands in a degenerate multiplet, the tensor is built from the
+    curvatures along x, y, z and along the diagonals x+y, x+z, y+z, see
+    band_derivatives(...). For warped multiplets, e.g. heavy and light
+    holes, the masses depend on the direction and this tensor is only
+    indicative; use band_derivatives(...) along the directions of interest.
+
+    Examples
+    --------
+    >>> M = inverse_mass_tensor(optimal, [0, 0, 0])
+    >>> masses = np.linalg.eigvalsh(np.linalg.inv(M[0]))
+    '''
+    s = 1/np.sqrt(2)
+    directions = [[1,0,0], [0,1,0], [0,0,1], [s,s,0], [s,0,s], [0,s,s]]
+    _, _, c = band_derivatives(model, k, directions, maxorder, tol, vtol)
+    pairs = {(0,1): 3, (0,2): 4, (1,2): 5}
+    M = np.empty(c.shape[:1] + c.shape[2:] + (3, 3))
+    for i in range(3):
+        M[:,:,i,i] = c[:,i]
+    # curvature along (e_i + e_j)/sqrt(2) is (c_ii + c_jj)/2 + c_ij
+    for (i, j), d in pairs.items():
+        M[:,:,i,j] = M[:,:,j,i] = c[:,d] - (c[:,i] + c[:,j])/2
+    return M/2
+
+def multiplets(values, tol):
+    '''
+    Groups sorted values that are closer than tol.
+
+    Returns
+    -------
+    list of lists
+        The indices of each group.
+    '''
+    groups = [[0]]
+    for i in range(1, len(values)):
+        if values[i] - values[i-1] < tol:
+            groups[-1].append(i)
+        else:
+            groups.append([i])
+    return groups
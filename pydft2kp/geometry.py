@@ -0,0 +1,201 @@
+'''
+Doc for the **pydft2kp/geometry.py** module.
+
+Quantum geometry of the kp models: Berry curvature and quantum metric from
+the Kubo formula, with the exact dH/dk of the polynomial models (Hdict or
+basis_transform) and stacked eigenvectors, for many k points at once.
+Integrals over a patch of k space give Chern and spin Chern (Z2)
+indicators.
+
+Units: the curvature and the metric are in Bohr², with k in Bohr^-1.
+'''
+
+import numpy as np
+from .lowdin import monomial_matrix, contract_monomials
+from .derivatives import polynomial_model, monomial_derivatives
+
+def quantum_geometry(model, k, occupied=None, spin=None, maxorder=2, tol=1e-6, chunk=4096):
+    '''
+    Calculates the Berry curvature and the quantum metric with the Kubo formula.
+
+    Parameters
+    ----------
+    model : irrep, basis_transform or dict
+        The kp model, see derivatives.polynomial_model(...).
+    k : array
+        The k points, shape (Nk, 3), or a single k point.
+    occupied : int or list of int, optional
+        The occupied bands (or their number, counted from the lowest).
+        If given, returns the results of the occupied manifold. Defaults
+        to None, for the band-resolved results.
+    spin : array, optional
+        Operator (N x N, in the basis of the model) used to choose the
+        states within degenerate multiplets, e.g. sigma_z x identity. See
+        Notes. Defaults to None.
+    maxorder : int, optional
+        Highest power of k taken from Hdict. Defaults to 2.
+    tol : float, optional
+        Energies (in Ry) closer than tol are treated as degenerate, and the
+        pairs of degenerate states are left out of the sums. Defaults to 1e-6.
+    chunk : int, optional
+        Number of k points processed at once. Defaults to 4096.
+
+    Returns
+    -------
+    Omega : array
+        The Berry curvature tensor :math:`\\Omega_{ij}`, shape (Nk, N, 3, 3),
+        or (Nk, 3, 3) for the occupied manifold.
+    g : array
+        The quantum metric :math:`g_{ij}`, with the same shape.
+
+    Notes
+    -----
+    For a band n,
+
+    .. math::
+        Q^n_{ij} = \\sum_{m \\neq n} \\frac{\\langle n|\\partial_i H|m\\rangle\\langle m|\\partial_j H|n\\rangle}{(E_n - E_m)^2},
+        \\quad g^n_{ij} = \\mathrm{Re}\\, Q^n_{ij},
+        \\quad \\Omega^n_{ij} = -2\\, \\mathrm{Im}\\, Q^n_{ij}.
+
+    For the occupied manifold, n runs over the occupied bands and m over
+    the empty ones. Within a degenerate multiplet only the sum over the
+    multiplet is gauge invariant. With spin given, the degenerate states
+    are chosen as eigenstates of spin (by adding a small multiple of it to
+    H), which gives spin-resolved curvatures when spin is conserved.
+
+    Examples
+    --------
+    >>> Omega, g = quantum_geometry(kp, k, occupied=2)
+    >>> Omega_z = Omega[:,0,1] # Berry curvature along z
+    '''
+    k = np.atleast_2d(np.asarray(k, dtype=float))
+    keys, T = polynomial_model(model, maxorder)
+    results = [_geometry(keys, T, k[s:s+chunk], occupied, spin, tol)
+               for s in range(0, len(k), chunk)]
+    Omega = np.concatenate([r[0] for r in results])
+    g = np.concatenate([r[1] for r in results])
+    return Omega, g
+
+def _geometry(keys, T, k, occupied, spin, tol):
+    # quantum geometric tensor of a chunk of k points, and the spin of each band
+    H = contract_monomials(monomial_matrix(k, keys), T)
+    if spin is not None:
+        # splits the degenerate states by less than tol, into eigenstates of spin
+        H = H + tol/10 * np.asarray(spin)
+    E, U = np.linalg.eigh(H)
+    dH = np.stack([contract_monomials(monomial_derivatives(k, keys, (i,)), T)
+                   for i in range(3)], axis=1)
+    P = U.conj().swapaxes(-1, -2)[:,None] @ dH @ U[:,None] # (Nk, 3, N, N)
+    dE = E[:,:,None] - E[:,None,:]
+    inv2 = np.where(np.abs(dE) < tol, 0, 1/np.where(np.abs(dE) < tol, 1, dE)**2)
+    N = E.shape[1]
+    if occupied is None:
+        # Q[n,i,j] = sum_m P[i,n,m] P[j,m,n] / (E_n - E_m)^2
+        Q = np.einsum('kinm,kjmn,knm->knij', P, P, inv2)
+    else:
+        occ = np.arange(occupied) if np.isscalar(occupied) else np.asarray(occupied)
+        emp = np.setdiff1d(np.arange(N), occ)
+        Po = P[:,:,occ][:,:,:,emp]
+        Pe = P[:,:,emp][:,:,:,occ]
+        Q = np.einsum('kinm,kjmn,knm->kij', Po, Pe, inv2[:,occ][:,:,emp])
+    s = None
+    if spin is not None:
+        s = np.einsum('kan,ab,kbn->kn', U.conj(), np.asarray(spin), U).real
+    return -2*Q.imag, Q.real, s
+
+def berry_curvature(model, k, occupied=None, spin=None, maxorder=2, tol=1e-6, chunk=4096):
+    '''
+    Calculates the Berry curvature pseudovector
+    :math:`(\\Omega_x, \\Omega_y, \\Omega_z) = (\\Omega_{yz}, \\Omega_{zx}, \\Omega_{xy})`.
+
+    Parameters
+    ----------
+    model, k, occupied, spin, maxorder, tol, chunk :
+        See quantum_geometry(...).
+
+    Returns
+    -------
+    array
+        Shape (Nk, N, 3) for the band-resolved curvature,
+        or (Nk, 3) for the occupied manifold.
+    '''
+    Omega, _ = quantum_geometry(model, k, occupied, spin, maxorder, tol, chunk)
+    return np.stack([Omega[...,1,2], Omega[...,2,0], Omega[...,0,1]], axis=-1)
+
+def chern_number(model, mesh, occupied, spin=None, maxorder=2, tol=1e-6, chunk=4096):
+    '''
+    Integrates the Berry curvature of the occupied manifold over a 2D
+    patch of k space.
+
+    Parameters
+    ----------
+    model : irrep, basis_transform or dict
+        The kp model, see derivatives.polynomial_model(...).
+    mesh : kmesh
+        A 2D mesh (one of its axes with a single value) covering the patch.
+        The integral uses the trapezoidal rule.
+    occupied : int or list of int
+        The occupied bands, see quantum_geometry(...).
+    spin : array, optional
+        If given, also calculates the spin Chern number with this operator,
+        e.g. the z component of the spin in the basis of the model.
+    maxorder, tol, chunk :
+        See quantum_geometry(...).
+
+    Returns
+    -------
+    dict
+        'chern': the integral of the curvature over 2pi. If spin is given,
+        also 'up' and 'down', the Chern numbers of the occupied states
+        with positive and negative spin, 'spin_chern' = (up - down)/2,
+        and 'z2' = round(spin_chern) mod 2.
+
+    Notes
+    -----
+    Over a finite patch around the expansion point the result converges
+    to an integer only if the curvature is well localized inside the
+    patch. A single massive Dirac cone contributes +-1/2, so a value close
+    to a half-integer indicates a valley (or surface) Chern number. The
+    spin Chern number, and the Z2 indicator, are meaningful when spin is
+    (approximately) conserved, as in BHZ-like models.
+
+    Examples
+    --------
+    >>> k = np.linspace(-0.3, 0.3, 301)
+    >>> chern_number(kp, kmesh(k, k, 0), occupied=2, spin=Sz)
+    '''
+    active = [c for c in range(3) if mesh.shape[c] > 1]
+    if len(active) != 2:
+        raise Exception('chern_number requires a 2D kmesh.')
+    i, j = active
+    # trapezoidal weights of the 2D mesh
+    weights = [np.gradient(ki) if len(ki) > 1 else np.ones(1) for ki in mesh.axes]
+    for w in weights:
+        if len(w) > 1:
+            w[0] /= 2
+            w[-1] /= 2
+    W = np.einsum('a,b,c->abc', *weights).ravel()
+    sign = 1 if (i, j) in [(0, 1), (1, 2)] else -1 # Omega_xy, Omega_yz or Omega_zx
+    occ = np.arange(occupied) if np.isscalar(occupied) else np.asarray(occupied)
+
+    keys, T = polynomial_model(model, maxorder)
+    total = up = down = 0
+    for start, stop, k in mesh.chunks(chunk):
+        if spin is None:
+            Omega, _, _ = _geometry(keys, T, k, occ, None, tol)
+            total += W[start:stop] @ Omega[:,i,j]
+        else:
+            # band-resolved, to split the occupied states by spin
+            Omega, _, s = _geometry(keys, T, k, None, spin, tol)
+            s = s[:,occ]
+            Oocc = Omega[:,occ,i,j]
+            total += W[start:stop] @ Oocc.sum(axis=1)
+            up += W[start:stop] @ np.sum(Oocc*(s > 0), axis=1)
+            down += W[start:stop] @ np.sum(Oocc*(s < 0), axis=1)
+    result = {'chern': sign*total/(2*np.pi)}
+    if spin is not None:
+        result['up'] = sign*up/(2*np.pi)
+        result['down'] = sign*down/(2*np.pi)
+        result['spin_chern'] = (result['up'] - result['down'])/2
+        result['z2'] = int(np.round(result['spin_chern'])) % 2
+    return result
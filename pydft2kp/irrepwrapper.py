@@ -14,7 +14,9 @@ import irrep.bandstructure as bs
 from .util import cwd, R_to_spin, R_to_bvec
 from .constants import Ry, a0, sx, sy, sz, alpha
 from .qe_aux import read_espresso, read_kp_dat
-from .lowdin import getHpowers, H_of_k
+from .lowdin import getHpowers, H_of_k, scan_remote_bands, block_sparse, LazyHdict, active_dims, fold_down
+from .lowdin import define_set_B, estimate_truncation_error
+from .cache import as_checkpoint, fold_down_cache
 
 class irrep():
     """
@@ -85,7 +87,7 @@ class irrep():
         Each line correspond to an operator. The first column
         refers to the matrix representation calculated from DFT,
         and the second column the one read from the QSYMM object. 
-    Hdict : dict
+    Hdict : LazyHdict
         Dictionary with the matrices that multiply the powers of momentum.
     setA : list or slice
         Stores the informed set A.
@@ -159,7 +161,8 @@ class irrep():
         # init list of anti-unitary symmetries
         self.antiU = []
 
-    def fold_down_H(self, NB=None, maxorder=2):
+    def fold_down_H(self, NB=None, maxorder=2, cache=None, n_workers=None, tol=None, verbose=False,
+                    sparse=False, dims=None, method='perturbative', checkpoint=None):
         """
         Uses Löwdin partitioning to calculate a dictionary
         with the matrices for each power of k.
@@ -168,15 +171,197 @@ class irrep():
             
         The calculation is done in the crude, original QE basis.
 
+        The dictionary is lazy: each order is only calculated when one of
+        its keys is first accessed. If only maxorder, cache, n_workers,
+        verbose or checkpoint change from the previous call, the orders
+        already calculated are reused, and the new settings apply to the
+        orders calculated next.
+
         Parameters
         ----------
         NB : int or None
             Number of bands to consider the set B above set A.
         maxorder : int
-            Maximum power of momentum.
+            Maximum power of momentum. Orders above 4 use the
+            generic Schrieffer-Wolff engine.
+        cache : fold_down_cache, bool or None
+            On-disk cache for the result. If True, uses the default
+            cache directory. See pydft2kp.cache.
+        n_workers : int or None
+            Number of processes used for orders 3 and 4. Scripts must
+            protect their entry point with if __name__ == '__main__':.
+        tol : float or None
+            If given, drops the bands of set B that contribute less than tol
+            to the fold-down, in the units of the k² coefficients (Ry.Bohr²),
+            see lowdin.screen_remote_bands(...).
+        verbose : bool
+            If True, prints the reports of the screening and of the sparsity.
+        sparse : bool
+            If True, the blocks of p between degenerate multiplets that vanish
+            by symmetry are skipped. See get_sparsity(...).
+        dims : str, tuple or None
+            Active directions of the momentum, e.g. ('x', 'y') for 2D systems
+            or ('z',) for wires. Only the monomials in these directions are
+            calculated. Defaults to None, all directions.
+        method : str
+            'perturbative' (default) or 'numerical', which fits the exact
+            eigenstates of H(k) on a stencil of k points. See
+            lowdin.numerical_fold_down(...).
+        checkpoint : str or None
+            Path of a checkpoint file (npz). Each order is written to it as
+            soon as it is calculated, and a rerun with the same inputs, e.g.
+            after the kernel dies, resumes from the stored orders.
+        """
+        multiplets = [ir[0] for ir in self.irreps] if sparse else None
+        Hdict = getattr(self, 'Hdict', None)
+        options = (tuple(self.setA), NB, tol, repr(multiplets), active_dims(dims))
+        if method == 'perturbative' and isinstance(Hdict, LazyHdict) and Hdict.options == options:
+            # same set B and V, reuse the orders already calculated
+            Hdict.maxorder = maxorder
+            Hdict.n_workers = n_workers
+            Hdict.cache = fold_down_cache() if cache is True else cache
+            Hdict.verbose = verbose
+            if checkpoint is not None:
+                Hdict.checkpoint = as_checkpoint(checkpoint)
+                Hdict.resumed = False
+        else:
+            self.Hdict = getHpowers(self, NB, maxorder, cache, n_workers, tol, verbose, multiplets, dims, 
+                                    method, checkpoint)
+
+    def fold_down_fields(self, fields, NB=None, maxorder=2, n_workers=None, tol=None, verbose=False,
+                         sparse=False):
+        """
+        Folds down the momentum together with other external fields, as
+        Zeeman, strain or electric field, in a single pass.
+
+        The calculation is done in the crude, original QE basis.
+
+        Parameters
+        ----------
+        fields : dict
+            Matrices (in the basis of all bands) that multiply each field, 
+            with the names of the fields as keys, e.g. 
+            {'Bx': self.sigma_x, 'By': self.sigma_y, 'Bz': self.sigma_z}.
+            The names 'x', 'y' and 'z' are reserved for the momentum.
+        NB, maxorder, n_workers, tol, verbose, sparse :
+            See fold_down_H(...). maxorder refers to the total order in
+            the momentum and the fields.
+
+        Returns
+        -------
+        dict
+            The keys are 0 and the tuples of field names, e.g. ('x', 'x'),
+            ('x', 'Bz') or ('Bz',). Use lowdin.H_of_fields(...) to evaluate it.
+        """
+        H0 = np.diag(self.energies)
+        # factor 2 below due to H = H0 + 2k.p + k²
+        Hs = {'x': 2*self.px, 'y': 2*self.py, 'z': 2*self.pz}
+        if set(fields) & set(Hs):
+            raise Exception('The names x, y and z are reserved for the momentum.')
+        Hs.update(fields)
+        multiplets = [ir[0] for ir in self.irreps] if sparse else None
+        h = fold_down(self.setA, H0, Hs, NB, maxorder, n_workers, tol, verbose, multiplets)
+        # k² from H = H0 + 2k.p + k²
+        if maxorder >= 2:
+            for c in 'xyz':
+                h[(c,c)] = h[(c,c)] + np.eye(len(self.setA))
+        return h
+
+    def estimate_truncation_error(self, kmax, maxorder=None):
+        """
+        Estimates the truncation error of the folded down model for each
+        order, without calculating the next order.
+
+        Uses the norms of the orders already in Hdict and the smallest gap
+        between sets A and B, see lowdin.estimate_truncation_error(...).
+
+        Parameters
+        ----------
+        kmax : float
+            Radius of the k region of interest, in Bohr^-1.
+        maxorder : int, optional
+            Highest order to consider. Defaults to the maxorder of fold_down_H(...).
+
+        Returns
+        -------
+        dict
+            The estimated truncation error (in Ry) of the model up to order n,
+            for n = 1, ..., maxorder. Choose the lowest order that meets the
+            target accuracy. These are heuristic estimates, not bounds.
+        """
+        Hdict = self.Hdict
+        if isinstance(Hdict, LazyHdict):
+            if maxorder is None:
+                maxorder = Hdict.maxorder
+            # set B, after the screening if any
+            B = Hdict.B
+        else:
+            if maxorder is None:
+                maxorder = max(len(key) for key in Hdict if key != 0 and np.any(Hdict[key] != 0))
+            B = define_set_B(len(self.energies), self.setA)
+        # active directions, from the nonzero terms of a numerical fold-down
+        dims = getattr(Hdict, 'dims', None)
+        if dims is None:
+            dims = active_dims([c for c in 'xyz' 
+                                if any(np.any(Hdict[key] != 0) for key in Hdict if key != 0 and c in key)])
+        V = 2*np.array([getattr(self, 'p'+c) for c in dims])
+        errors, _ = estimate_truncation_error(Hdict, kmax, self.energies, V, self.setA, B, maxorder, dims)
+        return errors
+
+    def get_sparsity(self, tol=1e-6):
+        """
+        Sparsity of the p matrices partitioned by the degenerate multiplets.
+
+        Parameters
+        ----------
+        tol : float, optional
+            Relative threshold for the blocks forbidden by symmetry.
+
+        Returns
+        -------
+        dict
+            Number of 'blocks' between multiplets (for px, py, pz), number
+            of 'forbidden' blocks, and 'density' of the nonzero elements.
         """
-        self.Hdict = getHpowers(self, NB, maxorder)
+        multiplets = [ir[0] for ir in self.irreps]
+        _, stats = block_sparse([self.px, self.py, self.pz], multiplets, tol)
+        return stats
     
+    def scan_remote_bands(self, NBs, qsymm, optimal):
+        """
+        Calculates the coefficients of the kp model for several numbers of
+        bands in set B at once, to check their convergence with NB.
+
+        The fold-down is done only once, up to second order, accumulating
+        the contributions of the remote bands in the order of their indices.
+        The coefficients are fitted for all NB values in a single least
+        squares problem, and no Heff callable is built.
+
+        Parameters
+        ----------
+        NBs : list or array
+            Numbers of bands to consider in set B above set A.
+        qsymm : qsymm object
+            Model built with our qsymm class
+        optimal : basis_transform object
+            Provides the transformation matrix U into the qsymm basis.
+
+        Returns
+        -------
+        coeffs : array, shape (len(NBs), ncoeffs)
+            Values of the coefficients cn for each NB, in a.u.
+
+        Notes
+        -----
+        Terms of order 3 and above are not cumulative over the bands
+        in set B, so they are set to zero in this scan.
+        """
+        H0 = np.diag(self.energies)
+        # factor 2 below due to H = H0 + 2k.p + k²
+        Hscan = scan_remote_bands(self.setA, H0, 2*self.px, 2*self.py, 2*self.pz, NBs)
+        coeffs, _ = optimal.get_coeffs(qsymm, self, Hscan)
+        return coeffs
+
     def build_H_of_k(self, all_bands=False):
         """
         Builds a callable function H(kx, ky, kz, [maxorder=2]).
@@ -190,7 +375,8 @@ class irrep():
         Returns
         -------
         callable
-            H(kx, ky, kz, [maxorder=2]).
+            H(kx, ky, kz, [maxorder=2]). Also accepts an (Nk, 3) array of
+            k points, H(k), and returns the stacked (Nk, N, N) Hamiltonians.
         """
 
         if all_bands:
@@ -303,7 +489,8 @@ class irrep():
 
         return irreps
     
-    def define_set_A(self, setA, verbose=True, NB=None, maxorder=2):
+    def define_set_A(self, setA, verbose=True, NB=None, maxorder=2, cache=None, n_workers=None, tol=None,
+                     sparse=False, dims=None, method='perturbative', checkpoint=None):
         """
         Verifies if the chosen set A is composed by full sets of irreps.
         If not, raises an error. If successful, defines set A and applies fold down.
@@ -318,6 +505,20 @@ class irrep():
             Number of bands to consider the set B above set A.
         maxorder : int, optional
             Maximum power of momentum.
+        cache : fold_down_cache, bool or None, optional
+            On-disk cache for the fold-down. See fold_down_H(...).
+        n_workers : int or None, optional
+            Number of processes for the fold-down. See fold_down_H(...).
+        tol : float or None, optional
+            Screening tolerance for set B. See fold_down_H(...).
+        sparse : bool, optional
+            Skips the blocks of p forbidden by symmetry. See fold_down_H(...).
+        dims : str, tuple or None, optional
+            Active directions of the momentum. See fold_down_H(...).
+        method : str, optional
+            'perturbative' or 'numerical' fold-down. See fold_down_H(...).
+        checkpoint : str or None, optional
+            Checkpoint file for the fold-down. See fold_down_H(...).
 
         Attributes
         ----------
@@ -373,7 +574,7 @@ class irrep():
         self.setA = setA
 
         # apply folding down
-        self.fold_down_H(NB, maxorder)
+        self.fold_down_H(NB, maxorder, cache, n_workers, tol, verbose, sparse, dims, method, checkpoint)
 
     def get_symm_matrices(self, setA=None, store=True):
         """
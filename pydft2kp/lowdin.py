@@ -2,9 +2,22 @@
 Doc for the **pydft2kp/lowdin.py** module.
 '''
 
+import os
 import numpy as np
+from functools import lru_cache
+from collections.abc import Mapping
+from scipy.sparse import csr_matrix
+from scipy.sparse.linalg import eigsh
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context, shared_memory
+from .cache import fold_down_cache, as_checkpoint, hash_inputs
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
 
-def getHpowers(irrep, NB=None, maxorder=2):
+def getHpowers(irrep, NB=None, maxorder=2, cache=None, n_workers=None, tol=None, verbose=False,
+               multiplets=None, dims=None, method='perturbative', checkpoint=None):
     """
     Returns a dictionary representing H terms that multiply powers of the momentum.
 
@@ -15,12 +28,44 @@ def getHpowers(irrep, NB=None, maxorder=2):
     NB : int or None, optional
         Number of bands to consider the set B above set A. Defaults to None.
     maxorder : int, optional
-        Maximum power of momentum. Defaults to 2.
+        Maximum power of momentum. Defaults to 2. Orders above 4 are
+        calculated by schrieffer_wolff(...).
+    cache : fold_down_cache, bool or None, optional
+        If given, the result is loaded from (or stored into) this on-disk
+        cache. If True, uses a fold_down_cache with default settings.
+        Defaults to None (no cache).
+    n_workers : int or None, optional
+        Number of processes used for orders 3 and 4, see lowdin(...).
+        Defaults to None (single process).
+    tol : float or None, optional
+        If given, screens out the bands of set B with negligible contributions,
+        see screen_remote_bands(...). In Ry.Bohr², the units of the k² terms.
+        Defaults to None (no screening).
+    verbose : bool, optional
+        If True, prints the reports of the screening and of the sparsity.
+    multiplets : list of lists or None, optional
+        Band indices of the degenerate multiplets. If given, the blocks of p
+        forbidden by symmetry are skipped, see block_sparse(...).
+    dims : str, tuple or None, optional
+        Active directions of the momentum, e.g. ('x', 'y') for 2D systems.
+        Keys with other directions are not calculated and return zeros.
+        Defaults to None, all directions.
+    method : str, optional
+        'perturbative' (default) for the Löwdin / Schrieffer-Wolff expansion,
+        or 'numerical' for a fit of the exact eigenstates on a stencil of
+        k points, see numerical_fold_down(...). The numerical fold-down uses
+        all bands and ignores NB, cache, n_workers, tol and multiplets.
+    checkpoint : str, checkpoint or None, optional
+        Path of a checkpoint file. Each order is written to it as soon as it
+        is calculated, and a rerun with the same inputs resumes from the
+        stored orders. Defaults to None (no checkpoint).
 
     Returns
     -------
-    dict
+    LazyHdict or dict
         Dictionary with the matrices that multiply the powers of momentum.
+        With the perturbative method, each order is only calculated when one
+        of its keys is accessed.
 
     Examples
     --------
@@ -37,7 +82,13 @@ def getHpowers(irrep, NB=None, maxorder=2):
     """
     H0 = np.diag(irrep.energies)
     # factor 2 below due to H = H0 + 2k.p + k²
-    return lowdin(irrep.setA, H0, 2*irrep.px, 2*irrep.py, 2*irrep.pz, NB, maxorder)
+    if method == 'numerical':
+        return numerical_fold_down(irrep.setA, H0, 2*irrep.px, 2*irrep.py, 2*irrep.pz, 
+                                   maxorder, dims=dims)
+    if method != 'perturbative':
+        raise Exception('Unknown fold-down method: ' + str(method))
+    return LazyHdict(irrep.setA, H0, 2*irrep.px, 2*irrep.py, 2*irrep.pz, NB, maxorder,
+                     n_workers, tol, verbose, multiplets, cache, dims, checkpoint)
 
 
 
@@ -63,7 +114,8 @@ def H_of_k(irrep, Hpow=None):
     H(kx, ky, kz, [maxorder=2]) : callable 
         A function that calculates the Hamiltonian H(k) up to a maximum order
         in the Löwdin expansion if Hpow is provided. Otherwise, it returns
-        the full Hamiltonian H.
+        the full Hamiltonian H. If kx is an (Nk, 3) array of k points, 
+        H(k) returns the stacked (Nk, N, N) Hamiltonians.
 
     Notes
     -----
@@ -75,55 +127,110 @@ def H_of_k(irrep, Hpow=None):
     Löwdin expansion truncated up to the maximum order specified by `maxorder`.
     The matrices that multiply the powers of momentum are provided in the
     `Hpow` dictionary.
+
+    In both cases the matrices are stacked into a (nmonomials, N, N) tensor,
+    which is contracted with the (Nk, nmonomials) matrix of the monomials
+    of k, see monomial_matrix(...). So a whole path of k points takes a
+    single matrix product.
+
+    Examples
+    --------
+    >>> H = H_of_k(kp, kp.Hdict)
+    >>> Hk = H(bands.k3D, maxorder=2) # shape (Nk, NA, NA)
+    >>> Ek = np.linalg.eigvalsh(Hk)
     '''
 
     if Hpow is None: # returns full H
-        H0 = np.diag(irrep.energies)
-        I0 = np.eye(len(irrep.energies))
+        # building H = H0 + 2k.p + k²
+        N = len(irrep.energies)
+        keys = [0, 'xx', 'x', 'y', 'z']
+        T = np.array([np.diag(irrep.energies), np.eye(N),
+                      2*irrep.px, 2*irrep.py, 2*irrep.pz], dtype=complex)
         def H(kx=0, ky=0, kz=0):
-            k2 = kx**2 + ky**2 + kz**2
-            # building H = H0 + 2k.p + k²
-            return (H0 + k2*I0 + 2*(irrep.px*kx + irrep.py*ky + irrep.pz*kz))
+            k, batched = k_points(kx, ky, kz)
+            M = monomial_matrix(k, keys)
+            # k² = kx² + ky² + kz² multiplies the identity
+            M[:,1] = np.sum(k**2, axis=1)
+            h = contract_monomials(M, T)
+            return h if batched else h[0]
         return H
     else: # returns H reduced to set A
+        # active directions, see LazyHdict(...)
+        dims = set(getattr(Hpow, 'dims', 'xyz'))
+        # stacked matrices for each maxorder, built on first use
+        tensors = {}
+        def stacked(maxorder):
+            # the LazyHdict may have its maxorder raised after H is built
+            tag = (maxorder, getattr(Hpow, 'maxorder', None))
+            if tag not in tensors:
+                keys = [key for key in Hpow 
+                        if key == 0 or len(key) <= maxorder and set(key) <= dims]
+                tensors[tag] = keys, np.array([Hpow[key] for key in keys], dtype=complex)
+            return tensors[tag]
         def H(kx=0, ky=0, kz=0, maxorder=2):
             '''
-            Returns H(kx,ky,kz) up to maxorder in the Löwdin expansion.
+            Returns H(kx,ky,kz) up to maxorder in the Löwdin expansion,
+            or the stacked H(k) for an (Nk, 3) array of k points.
             '''
-            # order 0
-            h  = Hpow[0] + 0j # trick: add 0j to make sure h is complex
-            # order 1
-            if maxorder >= 1:
-                h += Hpow['x']*kx + Hpow['y']*ky + Hpow['z']*kz
-            # order 2
-            if maxorder >= 2:
-                h += Hpow['xx']*kx**2 + Hpow['xy']*kx*ky + Hpow['xz']*kx*kz
-                h += Hpow['yy']*ky**2 + Hpow['yz']*ky*kz + Hpow['zz']*kz*kz
-            # order 3
-            if maxorder >= 3:
-                h += Hpow['xxx']*kx**3 + Hpow['yyy']*ky**3 + Hpow['zzz']*kz**3
-                h += Hpow['xxy']*kx*kx*ky + Hpow['xxz']*kx*kx*kz + Hpow['xyy']*kx*ky*ky
-                h += Hpow['xyz']*kx*ky*kz + Hpow['xzz']*kx*kz*kz + Hpow['yyz']*ky*ky*kz
-                h += Hpow['yzz']*ky*kz*kz
-            if maxorder >= 4:
-                h += Hpow['xxxx']*kx**4
-                h += Hpow['yyyy']*ky**4
-                h += Hpow['zzzz']*kz**4
-                h += Hpow['xxxy']*kx**3*ky
-                h += Hpow['xxxz']*kx**3*kz
-                h += Hpow['xyyy']*ky**3*kx
-                h += Hpow['yyyz']*ky**3*kz
-                h += Hpow['xzzz']*kz**3*kx
-                h += Hpow['yzzz']*kz**3*ky
-                h += Hpow['xxyy']*kx**2*ky**2
-                h += Hpow['xxzz']*kx**2*kz**2
-                h += Hpow['yyzz']*ky**2*kz**2
-                h += Hpow['xxyz']*kx**2*ky*kz
-                h += Hpow['xyyz']*ky**2*kx*kz
-                h += Hpow['xyzz']*kz**2*kx*ky
-            return h
+            k, batched = k_points(kx, ky, kz)
+            keys, T = stacked(maxorder)
+            h = contract_monomials(monomial_matrix(k, keys), T)
+            return h if batched else h[0]
         return H
 
+def k_points(kx=0, ky=0, kz=0):
+    """
+    Converts the arguments of H(kx, ky, kz) into an (Nk, 3) array.
+
+    Returns
+    -------
+    k : array
+        The k points, shape (Nk, 3).
+    batched : bool
+        True if kx is already an (Nk, 3) array of k points, and False
+        for scalar kx, ky, kz (Nk = 1).
+    """
+    k = np.asarray(kx)
+    if k.ndim == 2:
+        if k.shape[1] != 3:
+            raise Exception('The k points must be an (Nk, 3) array.')
+        return k, True
+    return np.array([[kx, ky, kz]]), False
+
+def monomial_matrix(k, keys):
+    """
+    Evaluates the monomials of k for each key.
+
+    Parameters
+    ----------
+    k : array
+        The k points, shape (Nk, 3).
+    keys : list
+        Keys of the monomials, e.g. [0, 'x', 'xx', 'xyz'].
+
+    Returns
+    -------
+    array
+        The (Nk, len(keys)) matrix with the monomials, e.g. 
+        kx*ky*kz for 'xyz' and 1 for the key 0.
+    """
+    # exponents (nx, ny, nz) of each key
+    E = np.array([[0 if key == 0 else key.count(c) for c in 'xyz'] for key in keys])
+    return np.prod(k[:,None,:]**E[None,:,:], axis=2)
+
+def contract_monomials(M, T):
+    """
+    Sums the matrices T[j] weighted by the monomials M[:,j], as a single
+    matrix product (Nk, nmonomials) x (nmonomials, N*N).
+
+    Returns
+    -------
+    array
+        The stacked (Nk, N, N) matrices.
+    """
+    N = T.shape[1]
+    return (M @ T.reshape(len(T), N*N)).reshape(len(M), N, N)
+
 # the order 2 term in Löwdin
 def order2(a, a1, B, e0, H1, H2):
     """
@@ -152,7 +259,177 @@ def order2(a, a1, B, e0, H1, H2):
 
     return np.sum([0.5*H1[a,b]*H2[b,a1]*(1/(e0[a]-e0[b]) + 1/(e0[a1]-e0[b])) for b in B])
 
+def energy_denominators(e0, A, B):
+    """
+    Builds the matrix of energy denominators between sets A and B.
+
+    Parameters
+    ----------
+    e0 : array
+        Eigenvalues.
+    A : list, array
+        List of the band indices in set A.
+    B : list, array
+        List of the band indices in set B.
+
+    Returns
+    -------
+    D : array, shape (NA, NB)
+        The matrix D[a,b] = 1/(e0[a]-e0[b]).
+    """
+    return 1/(e0[A][:,None] - e0[B][None,:])
+
+def blocks(V, A, B):
+    """
+    Splits the stacked perturbations into their Löwdin blocks.
+
+    Parameters
+    ----------
+    V : array, shape (n, N, N)
+        Stacked perturbations, the first index refers to the direction of k.
+    A : list, array
+        List of the band indices in set A.
+    B : list, array
+        List of the band indices in set B.
+
+    Returns
+    -------
+    VAA, VAB, VBA, VBB : arrays
+        Blocks <A|V|A>, <A|V|B>, <B|V|A> and <B|V|B>, with shapes
+        (n, NA, NA), (n, NA, NB), (n, NB, NA) and (n, NB, NB).
+    """
+    VA = V[:, A, :]
+    VB = V[:, B, :]
+    # contiguous copies, so that the stacked matmuls run on BLAS
+    return tuple(np.ascontiguousarray(X) for X in 
+                 (VA[:, :, A], VA[:, :, B], VB[:, :, A], VB[:, :, B]))
+
+# maximum density of <B|V|B> for the sparse products
+SPARSE_DENSITY = 0.1
+
+def block_sparse(V, multiplets, tol=1e-6):
+    """
+    Sets to zero the blocks of V between degenerate multiplets that vanish
+    by symmetry.
+
+    The selection rules make most blocks <I|Vi|J> between the multiplets I
+    and J vanish, but the DFT matrix elements carry a numerical noise.
+    Blocks with all elements below tol*max|V| are set exactly to zero.
+
+    Parameters
+    ----------
+    V : array, shape (n, N, N)
+        Stacked perturbations, the first index refers to the direction of k.
+    multiplets : list of lists
+        Band indices of each degenerate multiplet, e.g. the first entries
+        of irrep.irreps. Bands that are not listed are taken as singlets.
+    tol : float, optional
+        Relative threshold for the symmetry-forbidden blocks. Defaults to 1e-6.
+
+    Returns
+    -------
+    V : array, shape (n, N, N)
+        Copy of V with the forbidden blocks set to zero.
+    stats : dict
+        Sparsity statistics: number of 'blocks' (n x number of multiplets²),
+        number of 'forbidden' blocks, and 'density' of the nonzero elements.
+    """
+    V = np.array(V)
+    N = V.shape[-1]
+    # partition all bands into multiplets
+    listed = set(b for m in multiplets for b in m)
+    multiplets = [list(m) for m in multiplets] + [[b] for b in range(N) if b not in listed]
+    label = np.empty(N, dtype=int)
+    for i, m in enumerate(multiplets):
+        label[m] = i
+    # largest element of each block, with the bands sorted by multiplet
+    order = np.argsort(label, kind='stable')
+    starts = np.searchsorted(label[order], np.arange(len(multiplets)))
+    absV = np.abs(V)
+    if np.any(order != np.arange(N)):
+        absV = absV[:, order][:, :, order]
+    blockmax = np.maximum.reduceat(absV, starts, axis=1)
+    blockmax = np.maximum.reduceat(blockmax, starts, axis=2)
+    allowed = blockmax > tol*blockmax.max()
+    V[~allowed[:, label[:,None], label[None,:]]] = 0
+    stats = {'blocks': allowed.size, 
+             'forbidden': int((~allowed).sum()),
+             'density': np.count_nonzero(V)/V.size}
+    return V, stats
+
+def sparse_blocks(VBB):
+    """
+    Converts the <B|V|B> blocks into a list of sparse matrices, one per
+    direction, to be used by right_mul(...) and left_mul(...).
+
+    The sparse products are only faster than the dense BLAS ones for
+    small densities, so VBB is kept dense if more than SPARSE_DENSITY
+    of its elements are nonzero.
+
+    Parameters
+    ----------
+    VBB : array, shape (n, NB, NB)
+        Block of the stacked perturbations with forbidden blocks set to zero,
+        see block_sparse(...).
+
+    Returns
+    -------
+    list or array
+        The scipy.sparse.csr_matrix of each direction, or VBB itself
+        if it is too dense.
+    """
+    if np.count_nonzero(VBB) > SPARSE_DENSITY*VBB.size:
+        return VBB
+    return [csr_matrix(Vi) for Vi in VBB]
+
+def right_mul(X, M):
+    """
+    Products X[...] @ M[l] for all directions l, stored in a new axis before
+    the last two. M is a stacked array or a list from sparse_blocks(...).
+    """
+    if isinstance(M, np.ndarray):
+        return X[..., None, :, :] @ M
+    Y = X.reshape(-1, X.shape[-1])
+    return np.stack([(Ml.T @ Y.T).T.reshape(X.shape[:-1] + (-1,)) for Ml in M], axis=-3)
+
+def left_mul(M, X):
+    """
+    Products M[i] @ X[...] for all directions i, stored in a new first axis.
+    M is a stacked array or a list from sparse_blocks(...).
+    """
+    if isinstance(M, np.ndarray):
+        return M.reshape(M.shape[:1] + (1,)*(X.ndim-2) + M.shape[1:]) @ X
+    Y = np.moveaxis(X, -2, 0)
+    Z = Y.reshape(Y.shape[0], -1)
+    return np.stack([np.moveaxis((Mi @ Z).reshape((-1,) + Y.shape[1:]), 0, -2) for Mi in M])
+
+# the order 2 term in Löwdin for all (a, a1) and all directions
+def order2_tensor(D, VAB, VBA):
+    """
+    Calculates the second-order term of order2(...) for all (a, a1) in set A
+    and all pairs of directions at once.
+
+    With M[i,j] = (Vi_AB*D) @ Vj_BA, the term for the word (Vi, Vj) is
+    (M[i,j] + M[j,i]†)/2, since the denominator 1/(e0[a1]-e0[b]) follows
+    from the conjugate transpose of M for Hermitian perturbations.
+
+    Parameters
+    ----------
+    D : array, shape (NA, NB)
+        Energy denominators from energy_denominators(...).
+    VAB, VBA : arrays, shapes (n, NA, NB) and (n, NB, NA)
+        Blocks of the stacked perturbations, from blocks(...).
+
+    Returns
+    -------
+    h : array, shape (n, n, NA, NA)
+        The term h[i,j] for H1 = Vi and H2 = Vj.
+    """
+    M = np.einsum('iab,jbc->ijac', VAB*D, VBA, optimize=True)
+    return 0.5*(M + M.transpose(1,0,3,2).conj())
+
 # the order 3 term in Löwdin
+# reference implementation, slow: use order3_tensor(...) instead
 def order3(a, a1, A, B, e0, H1, H2, H3):
     """
     Calculates the third order term in the Löwdin expansion.
@@ -188,8 +465,314 @@ def order3(a, a1, A, B, e0, H1, H2, H3):
     o3 += np.sum([+0.5*H1[a,b] *H2[b,b1]*H3[b1,a1]/((e0[a1]-e0[b])*(e0[a1]-e0[b1])) for b in B for b1 in B])
     return o3
 
+# the order 3 term in Löwdin for all (a, a1) and all directions
+def order3_tensor(D, VAA, VAB, VBA, VBB):
+    """
+    Calculates the third-order term of order3(...) for all (a, a1) in set A
+    and all words of directions (i, j, l) at once. VBB may also be a list
+    of sparse matrices from sparse_blocks(...).
+
+    The A-B-A and A-B-B intermediates carry the energy denominators and are
+    built once as dense tensors with direction indices, so no product is
+    repeated for the permutations of a monomial. The terms are split into
+    order3_rows(...) and order3_cols(...), which can be evaluated on blocks
+    of set A by different processes, see parallel_tensors(...).
+
+    Parameters
+    ----------
+    D : array, shape (NA, NB)
+        Energy denominators from energy_denominators(...).
+    VAA, VAB, VBA, VBB : arrays
+        Blocks of the stacked perturbations, from blocks(...).
+
+    Returns
+    -------
+    h : array, shape (n, n, n, NA, NA)
+        The term h[i,j,l] for H1 = Vi, H2 = Vj and H3 = Vl.
+    """
+    return order3_rows(D, VAA, VAB, VBA, VBB) + order3_cols(D, VAB, VBA, VBB)
+
+def order3_rows(D, VAA, VAB, VBA, VBB, rows=slice(None), dirs=slice(None)):
+    """
+    Terms of order3_tensor(...) built from intermediates indexed by the row a.
+
+    Parameters
+    ----------
+    D : array, shape (NA, NB)
+        Energy denominators from energy_denominators(...).
+    VAA, VAB, VBA, VBB : arrays
+        Blocks of the stacked perturbations, from blocks(...).
+    rows : slice, optional
+        Rows a of the result, as positions in set A. Defaults to all.
+    dirs : slice, optional
+        First directions i of the words. Defaults to all.
+
+    Returns
+    -------
+    h : array, shape (ni, n, n, NAr, NA)
+        Contribution to h[i,j,l][a,a1] for the selected i and a.
+    """
+    DT = D.T
+    # <A|V|B> D and <B|V|A> D^T
+    VABD = VAB*D
+    VBAD = VBA*DT
+    Dr = D[rows]
+    VAAr = VAA[dirs][:, rows]
+    VABr = VAB[dirs][:, rows]
+    # A-B-A intermediates
+    # L[i,j,a,a2,a1] = sum_b Vi[a,b] Vj[b,a2] D[a2,b] D[a1,b]
+    # R[j,l,a,a2,a1] = sum_b D[a,b] Vj[a2,b] D[a2,b] Vl[b,a1]
+    L = np.einsum('iab,jbc,db->ijacd', VABr, VBAD, D, optimize=True)
+    R = np.einsum('ab,jcb,lbd->jlacd', Dr, VABD, VBA, optimize=True)
+    # A-B-B intermediate
+    # P[i,j,a,b1] = sum_b Vi[a,b] D[a,b] Vj[b,b1] D[a,b1]
+    P = right_mul(VABr*Dr, VBB)*Dr
+
+    h  = -0.5*np.einsum('ijacd,lcd->ijlad', L, VAA, optimize=True)
+    h += -0.5*np.einsum('iac,jlacd->ijlad', VAAr, R, optimize=True)
+    h += +0.5*(P[:,:,None] @ VBA[None,None,:])
+    return h
+
+def order3_cols(D, VAB, VBA, VBB, cols=slice(None), dirs=slice(None)):
+    """
+    Terms of order3_tensor(...) built from intermediates indexed by the column a1.
+
+    Parameters
+    ----------
+    D : array, shape (NA, NB)
+        Energy denominators from energy_denominators(...).
+    VAB, VBA, VBB : arrays
+        Blocks of the stacked perturbations, from blocks(...).
+    cols : slice, optional
+        Columns a1 of the result, as positions in set A. Defaults to all.
+    dirs : slice, optional
+        Last directions l of the words. Defaults to all.
+
+    Returns
+    -------
+    h : array, shape (n, n, nl, NA, NAc)
+        Contribution to h[i,j,l][a,a1] for the selected l and a1.
+    """
+    DTc = D.T[:, cols]
+    # A-B-B intermediate
+    # Q[j,l,b,a1] = sum_b1 Vj[b,b1] Vl[b1,a1] D[a1,b1] D[a1,b]
+    Q = left_mul(VBB, VBA[dirs][:, :, cols]*DTc)*DTc
+    return +0.5*(VAB[:,None,None] @ Q[None,:,:])
+
+# the order 4 term in Löwdin for all (a, a1) and all directions
+def order4_tensor(D, VAA, VAB, VBA, VBB):
+    """
+    Calculates the fourth-order term of order4(...) for all (a, a1) in set A
+    and all words of directions (i, j, l, m) at once. VBB may also be a
+    list of sparse matrices from sparse_blocks(...).
+
+    Each of the 18 terms of order4(...) is rewritten as a chain of matrix
+    products. The terms are grouped as [left] @ <B|Vm|A>, <A|Vi|B> @ [right]
+    and [A-A pair] @ [A-A pair], where the three-index intermediates [left]
+    (depends on i, j, l) and [right] (depends on j, l, m) are built once
+    and shared by all words. The cost is dominated by O(NA.NB²) products,
+    instead of the NA².NB³ Python loops of order4(...).
+
+    The rows of [left] and the columns of [right] are independent, so the
+    terms are split into order4_rows(...) and order4_cols(...), which can
+    be evaluated on blocks of set A by different processes, see
+    parallel_tensors(...).
+
+    Parameters
+    ----------
+    D : array, shape (NA, NB)
+        Energy denominators from energy_denominators(...).
+    VAA, VAB, VBA, VBB : arrays
+        Blocks of the stacked perturbations, from blocks(...).
+
+    Returns
+    -------
+    h : array, shape (n, n, n, n, NA, NA)
+        The term h[i,j,l,m] for H1 = Vi, H2 = Vj, H3 = Vl and H4 = Vm.
+    """
+    W, G = order4_pairs(D, VAB, VBA, VBB)
+    return (order4_rows(D, VAA, VAB, VBA, VBB, W) 
+          + order4_cols(D, VAA, VAB, VBA, VBB, G))
+
+def order4_pairs(D, VAB, VBA, VBB, rows=slice(None), cols=slice(None)):
+    """
+    A-B-B intermediates of order4_tensor(...), the most expensive pairs.
+
+    Parameters
+    ----------
+    D : array, shape (NA, NB)
+        Energy denominators from energy_denominators(...).
+    VAB, VBA, VBB : arrays
+        Blocks of the stacked perturbations, from blocks(...).
+    rows, cols : slice, optional
+        Rows of W and columns of G, as positions in set A. Defaults to all.
+
+    Returns
+    -------
+    W : array, shape (n, n, NAr, NB)
+        W[i,j,a,b1] = sum_b Vi[a,b] D[a,b] Vj[b,b1] D[a,b1]
+    G : array, shape (n, n, NB, NAc)
+        G[l,m,b,a1] = sum_b1 Vl[b,b1] Vm[b1,a1] D[a1,b1] D[a1,b]
+    """
+    Dr = D[rows]
+    DTc = D.T[:, cols]
+    W = right_mul(VAB[:, rows]*Dr, VBB)*Dr
+    G = left_mul(VBB, VBA[:, :, cols]*DTc)*DTc
+    return W, G
+
+def order4_rows(D, VAA, VAB, VBA, VBB, W, rows=slice(None), dirs=slice(None)):
+    """
+    Terms of order4_tensor(...) from [left] @ <B|Vm|A> and the A-A pairs.
+
+    Parameters
+    ----------
+    D : array, shape (NA, NB)
+        Energy denominators from energy_denominators(...).
+    VAA, VAB, VBA, VBB : arrays
+        Blocks of the stacked perturbations, from blocks(...).
+    W : array, shape (n, n, NA, NB)
+        Intermediate from order4_pairs(...), for all rows.
+    rows : slice, optional
+        Rows a of the result, as positions in set A. Defaults to all.
+    dirs : slice, optional
+        First directions i of the words. Defaults to all.
+
+    Returns
+    -------
+    h : array, shape (ni, n, n, n, NAr, NA)
+        Contribution to h[i,j,l,m][a,a1] for the selected i and a.
+    """
+    DT = D.T
+    # <A|V|B> D and <B|V|A> D^T
+    VABD = VAB*D
+    VBAD = VBA*DT
+    # restricted to the selected rows and first directions
+    Dr = D[rows]
+    VAAr = VAA[dirs][:, rows]
+    VABr = VAB[dirs][:, rows]
+    VABDr = VABr*Dr
+    # pairs of directions, shapes (n, n, ., .)
+    S1 = VABD[:,None] @ VBA[None,:]
+    S2 = VABD[:,None] @ VBAD[None,:]
+    S3 = VAB[:,None] @ VBAD[None,:]
+    P1 = D*(VAA[:,None] @ VABD[None,:])
+    S1r = VABDr[:,None] @ VBA[None,:]
+    S2r = VABDr[:,None] @ VBAD[None,:]
+    S3r = VABr[:,None] @ VBAD[None,:]
+    ADr = VAAr[:,None] @ VABD[None,:]
+    Wr = W[dirs][:, :, rows]
+    # broadcast (n,n,.,.) pairs and (n,.,.) blocks into (n,n,n,.,.)
+    p = lambda X: X[:,:,None]
+    q = lambda X: X[None,:,:]
+    v = lambda X: X[None,None,:]
+    u = lambda X: X[:,None,None]
+
+    # three-index intermediates, followed by @ <B|Vm|A>
+    left  = +0.5   *(u(VAAr) @ q(P1))*Dr
+    left += -0.5   *(u(VAAr) @ q(W))*Dr
+    left += -0.5   *right_mul(ADr*Dr, VBB)*Dr
+    left += +0.5   *right_mul(Wr, VBB)*Dr
+    left += -(8/24)*(p(S1r) @ v(VABD))*Dr
+    left += -(4/24)*(p(S2r) @ v(VAB))*Dr
+    left += -(4/24)*(p(S3r) @ v(VABD))*Dr
+    left += +(1/24)*(p(S2r) @ v(VABD))
+
+    h  = left[:,:,:,None] @ VBA[None,None,None,:]
+    h += (3/24)*(S2r[:,:,None,None] @ S3[None,None,:,:])
+    h += (3/24)*(S1r[:,:,None,None] @ S2[None,None,:,:])
+    return h
+
+def order4_cols(D, VAA, VAB, VBA, VBB, G, cols=slice(None), dirs=slice(None)):
+    """
+    Terms of order4_tensor(...) from <A|Vi|B> @ [right].
+
+    Parameters
+    ----------
+    D : array, shape (NA, NB)
+        Energy denominators from energy_denominators(...).
+    VAA, VAB, VBA, VBB : arrays
+        Blocks of the stacked perturbations, from blocks(...).
+    G : array, shape (n, n, NB, NA)
+        Intermediate from order4_pairs(...), for all columns.
+    cols : slice, optional
+        Columns a1 of the result, as positions in set A. Defaults to all.
+    dirs : slice, optional
+        Last directions m of the words. Defaults to all.
+
+    Returns
+    -------
+    h : array, shape (n, n, n, nm, NA, NAc)
+        Contribution to h[i,j,l,m][a,a1] for the selected m and a1.
+    """
+    DT = D.T
+    # <A|V|B> D and <B|V|A> D^T
+    VABD = VAB*D
+    VBAD = VBA*DT
+    # restricted to the selected columns and last directions
+    DTc = DT[:, cols]
+    VAAc = VAA[dirs][:, :, cols]
+    VBAc = VBA[dirs][:, :, cols]
+    VBADc = VBAc*DTc
+    # pairs of directions, shapes (n, n, ., .)
+    P2 = (VBAD[:,None] @ VAA[None,:])*DT
+    S1c = VABD[:,None] @ VBAc[None,:]
+    S2c = VABD[:,None] @ VBADc[None,:]
+    S3c = VAB[:,None] @ VBADc[None,:]
+    DAc = VBAD[:,None] @ VAAc[None,:]
+    Gc = G[:, dirs][:, :, :, cols]
+    # broadcast (n,n,.,.) pairs and (n,.,.) blocks into (n,n,n,.,.)
+    p = lambda X: X[:,:,None]
+    q = lambda X: X[None,:,:]
+    v = lambda X: X[None,None,:]
+    u = lambda X: X[:,None,None]
+
+    # three-index intermediates, preceded by <A|Vi|B> @
+    right  = +0.5   *(p(P2) @ v(VAAc))*DTc
+    right += -0.5   *(p(G) @ v(VAAc))*DTc
+    right += -0.5   *left_mul(VBB, DAc*DTc)*DTc
+    right += +0.5   *left_mul(VBB, Gc)*DTc
+    right += -(8/24)*(u(VBAD) @ q(S3c))*DTc
+    right += -(4/24)*(u(VBA) @ q(S2c))*DTc
+    right += -(4/24)*(u(VBAD) @ q(S1c))*DTc
+    right += +(1/24)*(u(VBAD) @ q(S2c))
+
+    return VAB[:,None,None,None] @ right[None,:,:,:]
+
+def tensor_to_monomials(T, labels='xyz'):
+    """
+    Splits a tensor with direction indices into the commutative monomials
+    of the momentum, summing over all permutations of the directions.
+
+    Parameters
+    ----------
+    T : array, shape (n, ..., n, NA, NA)
+        Term with one direction index per power of the momentum.
+    labels : str or list, optional
+        Label of each direction. Defaults to 'xyz'.
+
+    Returns
+    -------
+    h : dict
+        Terms summed over all permutations, with sorted keys as 'xxy'.
+        If labels is a list of names, the keys are tuples of names,
+        sorted as in labels, e.g. ('x', 'x', 'Bz').
+    """
+    order = T.ndim - 2
+    h = {}
+    for word in np.ndindex(T.shape[:order]):
+        if isinstance(labels, str):
+            key = ''.join(sorted(labels[i] for i in word))
+        else:
+            key = tuple(labels[i] for i in sorted(word))
+        if key in h:
+            h[key] = h[key] + T[word]
+        else:
+            h[key] = T[word].copy()
+    return h
+
+
 # the order 4 term in Löwdin
-# VERY SLOW, REQUIRES MULTIPROCESSING: DO NOT USE!!!
+# reference implementation, very slow: use order4_tensor(...) instead
 def order4(a, a1, A, B, e0, H1, H2, H3, H4):
     """
     Calculates the order 4 term in the Löwdin expansion.
@@ -250,7 +833,338 @@ def order4(a, a1, A, B, e0, H1, H2, H3, H4):
     #--------
     return o4
 
-def lowdin(A, H0, Hx, Hy, Hz, NB=None, maxorder=2):
+def screen_remote_bands(e0, V, A, B, tol):
+    """
+    Drops the bands of set B with negligible contributions to the fold-down.
+
+    The contribution of a band b to the second-order term of any word
+    h[i,j][a,a1] is bounded by the weight
+
+        w_b = max_{i,a} |Vi[a,b]|² / min_a |e0[a]-e0[b]|.
+
+    The weakest bands are dropped while the sum of their weights stays below
+    tol, so the neglected second-order part is certified to be below tol.
+    Their contributions to orders 3 and 4 carry extra powers of the small
+    ratio |Vi[a,b]|/|e0[a]-e0[b]|.
+
+    Unlike NB, which truncates set B by band index, the screening is done
+    by contribution, so it also removes weak bands below set A.
+
+    Parameters
+    ----------
+    e0 : array
+        Eigenvalues.
+    V : array, shape (n, N, N)
+        Stacked perturbations, the first index refers to the direction of k.
+    A, B : array
+        Band indices of sets A and B.
+    tol : float
+        Tolerance for the neglected part, in the units of the second-order
+        terms, |V|²/energy (Ry.Bohr² for the k.p perturbations).
+
+    Returns
+    -------
+    B : array
+        Band indices of the screened set B, in increasing order.
+    bound : float
+        Certified bound for the change of any element of h[i,j] at second
+        order. Each monomial, e.g. 'xy', sums up to n! words.
+    """
+    B = np.asarray(B)
+    if len(B) == 0:
+        return B, 0.0
+    gap = np.abs(e0[A][:,None] - e0[B][None,:]).min(axis=0)
+    w = (np.abs(V[:, A, :][:, :, B])**2).max(axis=(0,1))/gap
+    # drop the weakest bands while the accumulated weight is below tol
+    order = np.argsort(w)
+    dropped = np.cumsum(w[order]) <= tol
+    bound = w[order][dropped].sum()
+    return np.sort(B[order[~dropped]]), bound
+
+def sparse_report(VBB, stats, verbose=False):
+    # converts <B|V|B> into sparse matrices and prints the report
+    stats['density_BB'] = np.count_nonzero(VBB)/max(1, VBB.size)
+    VBB = sparse_blocks(VBB)
+    if verbose:
+        print('Block-sparse V:', stats['forbidden'], 'of', stats['blocks'], 
+              'blocks forbidden by symmetry.', 
+              'Density of <B|V|B>: %.1f%%' % (100*stats['density_BB']),
+              '(sparse products)' if isinstance(VBB, list) else '(dense products)')
+    return VBB
+
+def screen_report(e0, V, A, B, tol, verbose=False):
+    # screens set B and prints the report
+    Bscreened, bound = screen_remote_bands(e0, V, A, B, tol)
+    if verbose:
+        print('Screening set B: kept', len(Bscreened), 'of', len(B), 'bands.',
+              'Neglected 2nd order part <=', '%.2e' % bound)
+    return Bscreened
+
+# environment variables that set the number of BLAS threads
+BLAS_THREADS_ENV = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 
+                    'BLIS_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS']
+
+# state of each worker process of parallel_tensors(...)
+_pool = {}
+
+def _share(x):
+    # copies x into a new shared memory block
+    shm = shared_memory.SharedMemory(create=True, size=max(x.nbytes, 1))
+    np.ndarray(x.shape, dtype=x.dtype, buffer=shm.buf)[...] = x
+    return shm, (shm.name, x.shape, x.dtype.str)
+
+def _attach(shared):
+    # views of arrays in shared memory, each block attached once per process
+    arrays = []
+    for name, shape, dtype in shared:
+        if name not in _pool['shm']:
+            _pool['shm'][name] = shared_memory.SharedMemory(name=name)
+        arrays.append(np.ndarray(shape, dtype=dtype, buffer=_pool['shm'][name].buf))
+    return arrays
+
+def _pool_init(shared, A, B, blas_threads, sparse):
+    # limits BLAS threads, attaches to V and e0, and builds the blocks once
+    if threadpool_limits is not None:
+        _pool['limits'] = threadpool_limits(blas_threads)
+    _pool['shm'] = {}
+    V, e0 = _attach(shared)
+    VAA, VAB, VBA, VBB = blocks(V, A, B)
+    if sparse:
+        VBB = sparse_blocks(VBB)
+    _pool['args'] = (energy_denominators(e0, A, B), VAA, VAB, VBA, VBB)
+
+def _pool_pairs(rows, shared):
+    # writes the rows of W and the columns of G into shared memory
+    D, VAA, VAB, VBA, VBB = _pool['args']
+    W, G = _attach(shared)
+    W[:, :, rows], G[..., rows] = order4_pairs(D, VAB, VBA, VBB, rows, rows)
+
+def _pool_orders(maxorder, rows, dirs, shared):
+    W, G = _attach(shared) if maxorder >= 4 else (None, None)
+    return order_blocks(*_pool['args'], W, G, maxorder, rows, dirs)
+
+def order_blocks(D, VAA, VAB, VBA, VBB, W, G, maxorder, rows, dirs):
+    '''
+    Rows and columns of orders 3 and 4 for a block of set A and a
+    direction, the work items of parallel_tensors(...) and serial_tensors(...).
+
+    Returns
+    -------
+    list of arrays
+        order3_rows(...) and order3_cols(...), followed by order4_rows(...)
+        and order4_cols(...) if maxorder >= 4.
+    '''
+    h = [order3_rows(D, VAA, VAB, VBA, VBB, rows, dirs),
+         order3_cols(D, VAB, VBA, VBB, rows, dirs)]
+    if maxorder >= 4:
+        h += [order4_rows(D, VAA, VAB, VBA, VBB, W, rows, dirs),
+              order4_cols(D, VAA, VAB, VBA, VBB, G, rows, dirs)]
+    return h
+
+def _add_blocks(T3, T4, h, rows, dirs):
+    # adds the results of order_blocks(...) to the tensors
+    T3[dirs,...,rows,:] += h[0]
+    T3[...,dirs,:,:][...,rows] += h[1]
+    if T4 is not None:
+        T4[dirs,...,rows,:] += h[2]
+        T4[...,dirs,:,:][...,rows] += h[3]
+
+def _block_name(rows, nblocks, dirs):
+    # name of a work item, with the number of blocks of set A
+    return f'{nblocks}.{rows}.{dirs}'
+
+def serial_tensors(D, VAA, VAB, VBA, VBB, maxorder, done=None, store=None):
+    '''
+    Calculates order3_tensor(...) and order4_tensor(...) in the work items
+    of parallel_tensors(...), in a single process, so that each finished
+    item can be checkpointed.
+
+    Parameters
+    ----------
+    D, VAA, VAB, VBA, VBB : arrays
+        Energy denominators and blocks, see prepare_blocks(...).
+    maxorder : int
+        3 or 4.
+    done, store :
+        Finished work items and callback, see parallel_tensors(...).
+
+    Returns
+    -------
+    T3, T4 : arrays
+        As in parallel_tensors(...).
+    '''
+    done = {} if done is None else done
+    n, NA = VAA.shape[:2]
+    T3 = np.zeros((n,)*3 + (NA, NA), dtype=complex)
+    T4 = np.zeros((n,)*4 + (NA, NA), dtype=complex) if maxorder >= 4 else None
+    W = G = None
+    if maxorder >= 4:
+        if 'pairs' in done:
+            W, G = done['pairs']
+        else:
+            W, G = order4_pairs(D, VAB, VBA, VBB)
+            if store is not None:
+                store('pairs', [W, G])
+    for i in range(n):
+        name = _block_name(0, 1, i)
+        h = done.get(name)
+        if h is None:
+            h = order_blocks(D, VAA, VAB, VBA, VBB, W, G, maxorder, slice(None), slice(i, i+1))
+            if store is not None:
+                store(name, h)
+        _add_blocks(T3, T4, h, slice(None), slice(i, i+1))
+    return T3, T4
+
+def parallel_tensors(A, B, e0, V, maxorder, n_workers, blas_threads=None, sparse=False,
+                     done=None, store=None):
+    """
+    Calculates order3_tensor(...) and order4_tensor(...) on a process pool.
+
+    The work is split into independent items: blocks of rows (columns) of
+    set A times the first (last) direction of the words, see order3_rows(...),
+    order3_cols(...), order4_rows(...) and order4_cols(...). The perturbations
+    V and the eigenvalues e0 are placed once in shared memory, and each
+    worker builds the blocks of V only once. The A-B-B pairs W and G of
+    order 4, see order4_pairs(...), are also written by the workers into
+    shared memory, so the tasks only carry their slices of set A.
+
+    Parameters
+    ----------
+    A, B : array
+        Band indices of sets A and B.
+    e0 : array
+        Eigenvalues.
+    V : array, shape (n, N, N)
+        Stacked perturbations, the first index refers to the direction of k.
+    maxorder : int
+        3 or 4.
+    n_workers : int
+        Number of processes.
+    blas_threads : int or None, optional
+        Number of BLAS threads in each process. Defaults to the number of
+        cores divided by n_workers, to avoid oversubscription.
+    sparse : bool, optional
+        If True, the workers store <B|V|B> as sparse matrices, see
+        sparse_blocks(...). V must come from block_sparse(...).
+    done : dict, optional
+        Work items finished by a previous run, as given to store. They are
+        used instead of being calculated again.
+    store : callable, optional
+        Called as store(name, arrays) after each work item finishes: the
+        pairs [W, G], and then the lists of order_blocks(...). Used for
+        the checkpoints of LazyHdict(...).
+
+    Returns
+    -------
+    T3, T4 : arrays
+        The results of order3_tensor(...) and order4_tensor(...).
+        T4 is None if maxorder < 4.
+
+    Notes
+    -----
+    The processes are started with the 'spawn' method, so scripts that call
+    this function must protect their entry point with 
+    if __name__ == '__main__':. The number of BLAS threads is set through
+    threadpoolctl, if installed, and through the usual environment variables.
+    """
+    NA = len(A)
+    n = len(V)
+    if blas_threads is None:
+        blas_threads = max(1, (os.cpu_count() or 1)//n_workers)
+    # work items: contiguous blocks of set A times the directions
+    nblocks = min(NA, -(-n_workers//n))
+    rows = [slice(b[0], b[-1]+1) for b in np.array_split(np.arange(NA), nblocks)]
+    dirs = [slice(i, i+1) for i in range(n)]
+
+    T3 = np.zeros((n,)*3 + (NA, NA), dtype=complex)
+    T4 = np.zeros((n,)*4 + (NA, NA), dtype=complex) if maxorder >= 4 else None
+
+    done = {} if done is None else done
+    W = G = None
+    shared = [_share(np.ascontiguousarray(V)), _share(np.ascontiguousarray(e0))]
+    pairs = []
+    if maxorder >= 4:
+        pairs = [_share(np.empty((n, n, NA, len(B)), dtype=complex)),
+                 _share(np.empty((n, n, len(B), NA), dtype=complex))]
+    env = {key: os.environ.get(key) for key in BLAS_THREADS_ENV}
+    os.environ.update({key: str(blas_threads) for key in BLAS_THREADS_ENV})
+    try:
+        with ProcessPoolExecutor(n_workers, mp_context=get_context('spawn'), 
+                                 initializer=_pool_init, 
+                                 initargs=([info for _, info in shared], A, B, blas_threads, sparse)) as pool:
+            # first pass: the A-B-B pairs of order 4, needed by all blocks
+            info = [info for _, info in pairs]
+            if maxorder >= 4:
+                W, G = [np.ndarray(shape, dtype=dtype, buffer=shm.buf) 
+                        for shm, (_, shape, dtype) in pairs]
+                if 'pairs' in done:
+                    W[...], G[...] = done['pairs']
+                else:
+                    for job in [pool.submit(_pool_pairs, r, info) for r in rows]:
+                        job.result()
+                    if store is not None:
+                        store('pairs', [W.copy(), G.copy()])
+            # second pass: rows and columns of orders 3 and 4
+            jobs = {}
+            for i, r in enumerate(rows):
+                for d in dirs:
+                    name = _block_name(i, len(rows), d.start)
+                    if name in done:
+                        _add_blocks(T3, T4, done[name], r, d)
+                    else:
+                        jobs[pool.submit(_pool_orders, maxorder, r, d, info)] = (r, d, name)
+            for job in as_completed(jobs):
+                r, d, name = jobs[job]
+                h = job.result()
+                _add_blocks(T3, T4, h, r, d)
+                if store is not None:
+                    store(name, h)
+    finally:
+        for key, value in env.items():
+            if value is None:
+                os.environ.pop(key)
+            else:
+                os.environ[key] = value
+        # releases the views of the pairs before closing the blocks
+        W = G = None
+        for shm, _ in shared + pairs:
+            shm.close()
+            shm.unlink()
+    return T3, T4
+
+def define_set_B(N, A, NB=None):
+    """
+    Defines Löwdin's set B from set A.
+
+    Parameters
+    ----------
+    N : int
+        Total number of bands.
+    A : list, array
+        List of the band indices in set A.
+    NB : int or None, optional
+        Number of bands in set B above set A. If None, set B contains
+        all bands not in set A. Defaults to None.
+
+    Returns
+    -------
+    B : array
+        List of the band indices in set B: all bands below set A,
+        and NB bands above it.
+    """
+    fullset = np.arange(N)
+    A = np.array(A)
+    if NB is None:
+        B = np.array([F for F in fullset if F not in A])
+    else:
+        firstA = np.where(fullset == A[0])[0][0]
+        lastA = np.where(fullset == A[-1])[0][0]
+        B = fullset[0:firstA] # all until firtA
+        B = np.append(B, fullset[(lastA+1):(lastA+1+NB)]) # NB above lastA
+    return B
+
+def lowdin(A, H0, Hx, Hy, Hz, NB=None, maxorder=2, n_workers=None, tol=None, verbose=False,
+           multiplets=None, checkpoint=None):
     '''
     Folds down H into the selected setA
     
@@ -266,306 +1180,852 @@ def lowdin(A, H0, Hx, Hy, Hz, NB=None, maxorder=2):
             Number of bands in set B, above A
         maxorder: int
             Calculate the expansion up to this order
+        n_workers: int or None
+            If > 1, orders 3 and 4 are calculated on a process pool,
+            see parallel_tensors(...)
+        tol: float or None
+            If given, drops the bands of set B whose contributions are
+            below tol, see screen_remote_bands(...)
+        verbose: bool
+            If True, prints the reports of the screening and of the sparsity
+        multiplets: list of lists or None
+            Band indices of the degenerate multiplets. If given, the blocks
+            forbidden by symmetry are skipped, see block_sparse(...)
+        checkpoint: str, checkpoint or None
+            If given, each order is written to this checkpoint file as soon
+            as it is calculated, and a rerun with the same inputs resumes
+            from the last completed order
     
     Returns
     -------
         h : dict
             folded down h = h0 + hx.kx + hy.ky + hz.kz + hxx.kx² + hxy.kx.ky + ...
+
+    Notes
+    -----
+    The perturbations are stacked as V = [Hx, Hy, Hz], so each order n is
+    calculated at once as a tensor h[i1,...,in,a,a1] over the directions of
+    k, see order2_tensor(...), order3_tensor(...) and order4_tensor(...).
+    The tensor is then summed over the permutations of the directions
+    to give the monomials 'xx', 'xy', ..., 'xyzz'. The orders are calculated
+    by LazyHdict(...), and this function returns all of them at once.
     '''
-    # get size of Hs (next version: use asserts)
-    N = len(H0)
-    NA = len(A)
-    
-    # define set B
-    fullset = np.arange(N)
+    h = LazyHdict(A, H0, Hx, Hy, Hz, NB, maxorder, n_workers, tol, verbose, multiplets,
+                  checkpoint=checkpoint)
+    return {key: h[key] for key in h}
+
+def prepare_blocks(A, H0, V, NB=None, tol=None, multiplets=None, verbose=False):
+    """
+    Builds the intermediates shared by all orders of the fold-down.
+
+    Parameters
+    ----------
+    A : array
+        Band indices of set A.
+    H0 : array, shape (N, N)
+        Diagonal unperturbed Hamiltonian.
+    V : array, shape (n, N, N)
+        Stacked perturbations.
+    NB, tol, multiplets, verbose :
+        Set B size, screening tolerance, degenerate multiplets and
+        reports, see lowdin(...).
+
+    Returns
+    -------
+    B, e0, V, D, VAA, VAB, VBA, VBB : arrays
+        Set B, eigenvalues, perturbations (with the forbidden blocks set
+        to zero if multiplets is given), energy denominators and blocks.
+    """
     A = np.array(A)
-    if NB is None:
-        B = np.array([F for F in fullset if F not in A])
-    else:
-        firstA = np.where(fullset == A[0])[0][0]
-        lastA = np.where(fullset == A[-1])[0][0]
-        B = fullset[0:firstA] # all until firtA
-        B = np.append(B, fullset[(lastA+1):(lastA+1+NB)]) # NB above lastA
-    
-    # eigenstates, assuming E0 from H0 diagonal
+    B = define_set_B(len(H0), A, NB)
     e0 = np.diag(H0)
-    
-    # order 0
-    h0 = H0[A,:][:,A]
-    
-    # order 1
-    hx = np.zeros([NA,NA], dtype=complex)
-    hy = np.zeros([NA,NA], dtype=complex)
-    hz = np.zeros([NA,NA], dtype=complex)
+    # skip the blocks forbidden by symmetry
+    if multiplets is not None:
+        V, stats = block_sparse(V, multiplets)
+    # drop the remote bands with negligible contributions
+    if tol is not None:
+        B = screen_report(e0, V, A, B, tol, verbose)
+    VAA, VAB, VBA, VBB = blocks(V, A, B)
+    if multiplets is not None:
+        VBB = sparse_report(VBB, stats, verbose)
+    # energy denominators, computed once for all orders
+    D = energy_denominators(e0, A, B)
+    return B, e0, V, D, VAA, VAB, VBA, VBB
+
+def fold_down(A, H0, Hs, NB=None, maxorder=2, n_workers=None, tol=None, verbose=False,
+              multiplets=None):
+    '''
+    Folds down H = H0 + sum_n f_n Hs[n] into the selected setA, for a general
+    set of perturbations, e.g. momentum, Zeeman, strain or electric field.
+
+    All perturbations share the same energy denominators and blocks, so the
+    mixed terms (e.g. k_x B_z) are obtained in a single pass.
+
+    Parameters
+    ----------
+        A: int list/array
+            set of states considered as Löwdin's set A
+        H0: NxN array
+            Diagonal entries.
+        Hs: dict
+            Perturbation matrices (NxN) that multiply each field f_n, with the
+            names of the fields as keys, e.g. {'x': 2*px, 'y': 2*py, 'z': 2*pz,
+            'Bz': sigma_z}.
+        NB: int
+            Number of bands in set B, above A
+        maxorder: int
+            Calculate the expansion up to this total order in the fields
+        n_workers, tol, verbose, multiplets:
+            Process pool, screening of set B, reports and block-sparse V,
+            see lowdin(...)
+
+    Returns
+    -------
+        h : dict
+            folded down h = h0 + sum_n h[(n,)] f_n + sum_{n<=m} h[(n,m)] f_n f_m + ...
+            The keys are 0 and the tuples of field names, sorted as in Hs,
+            e.g. ('x',), ('x', 'Bz'), ('Bz', 'Bz'). Use H_of_fields(...) to
+            evaluate h.
+
+    Notes
+    -----
+    The perturbations must be linear in the fields. Quadratic terms of the
+    full Hamiltonian, as the k² of H = H0 + 2k.p + k², must be added to h
+    afterwards, see irrep.fold_down_fields(...).
+    '''
+    names = list(Hs)
+    A = np.array(A)
+    V = np.array([Hs[name] for name in names])
+    B, e0, V, D, VAA, VAB, VBA, VBB = prepare_blocks(A, H0, V, NB, tol, multiplets, verbose)
+
+    h = {0: H0[A,:][:,A]}
     if maxorder >= 1:
-        hx = Hx[A,:][:,A]
-        hy = Hy[A,:][:,A]
-        hz = Hz[A,:][:,A]
-    
-    # order 2
-    hxx = np.zeros([NA,NA], dtype=complex)
-    hxy = np.zeros([NA,NA], dtype=complex)
-    hxz = np.zeros([NA,NA], dtype=complex)
-    hyy = np.zeros([NA,NA], dtype=complex)
-    hyz = np.zeros([NA,NA], dtype=complex)
-    hzz = np.zeros([NA,NA], dtype=complex)
+        h.update(tensor_to_monomials(VAA, names))
     if maxorder >= 2:
-        for ia in range(NA):
-            for ja in range(NA):
-                a = A[ia]
-                a1 = A[ja]
-                
-                # (X+Y+Z)² = X² + Y² + Z² + (X.Y + Y.X) + (X.Z + Z.X) + (Y.Z + Z.Y)
-                
-                hxx[ia,ja]  = order2(a, a1, B, e0, Hx, Hx)
-                hyy[ia,ja]  = order2(a, a1, B, e0, Hy, Hy)
-                hzz[ia,ja]  = order2(a, a1, B, e0, Hz, Hz)
-                
-                hxy[ia,ja]  = order2(a, a1, B, e0, Hx, Hy)
-                hxy[ia,ja] += order2(a, a1, B, e0, Hy, Hx)
-                
-                hxz[ia,ja]  = order2(a, a1, B, e0, Hx, Hz)
-                hxz[ia,ja] += order2(a, a1, B, e0, Hz, Hx)
-                
-                hyz[ia,ja]  = order2(a, a1, B, e0, Hy, Hz)
-                hyz[ia,ja] += order2(a, a1, B, e0, Hz, Hy)
-   
-    # order 3
-    hxxx = np.zeros([NA,NA], dtype=complex)
-    hyyy = np.zeros([NA,NA], dtype=complex)
-    hzzz = np.zeros([NA,NA], dtype=complex)
-    hxxy = np.zeros([NA,NA], dtype=complex)
-    hxxz = np.zeros([NA,NA], dtype=complex)
-    hxyy = np.zeros([NA,NA], dtype=complex)
-    hxyz = np.zeros([NA,NA], dtype=complex)
-    hxzz = np.zeros([NA,NA], dtype=complex)
-    hyyz = np.zeros([NA,NA], dtype=complex)
-    hyzz = np.zeros([NA,NA], dtype=complex)
+        h.update(tensor_to_monomials(order2_tensor(D, VAB, VBA), names))
+    # orders 3 and 4 on a process pool
+    if n_workers is not None and n_workers > 1 and maxorder >= 3:
+        T3, T4 = parallel_tensors(A, B, e0, V, min(maxorder, 4), n_workers, 
+                                  sparse=multiplets is not None)
+    else:
+        T3 = T4 = None
     if maxorder >= 3:
-        for ia in range(NA):
-            for ja in range(NA):
-                a = A[ia]
-                a1 = A[ja]
-                
-                # (X+Y+Z)³ = X³ + Y³ + Z³
-                #          + XXY + XYX + YXX 
-                #          + XXZ + XZX + ZXX 
-                #          + XYY + YXY + YYX 
-                #          + XYZ + XZY + YXZ + YZX + ZXY + ZYX 
-                #          + XZZ + ZXZ + ZZX
-                #          + YYZ + YZY + ZYY
-                #          + YZZ + ZYZ + ZZY
-                
-                hxxx[ia,ja]  = order3(a, a1, A, B, e0, Hx, Hx, Hx)
-                hyyy[ia,ja]  = order3(a, a1, A, B, e0, Hy, Hy, Hy)
-                hzzz[ia,ja]  = order3(a, a1, A, B, e0, Hz, Hz, Hz)
-                
-                hxxy[ia,ja]  = order3(a, a1, A, B, e0, Hx, Hx, Hy)
-                hxxy[ia,ja] += order3(a, a1, A, B, e0, Hx, Hy, Hx)
-                hxxy[ia,ja] += order3(a, a1, A, B, e0, Hy, Hx, Hx)
-                
-                hxxz[ia,ja]  = order3(a, a1, A, B, e0, Hx, Hx, Hz)
-                hxxz[ia,ja] += order3(a, a1, A, B, e0, Hx, Hz, Hx)
-                hxxz[ia,ja] += order3(a, a1, A, B, e0, Hz, Hx, Hx)
-                
-                hxyy[ia,ja]  = order3(a, a1, A, B, e0, Hy, Hy, Hx)
-                hxyy[ia,ja] += order3(a, a1, A, B, e0, Hy, Hx, Hy)
-                hxyy[ia,ja] += order3(a, a1, A, B, e0, Hx, Hy, Hy)
-                
-                hxyz[ia,ja]  = order3(a, a1, A, B, e0, Hx, Hy, Hz)
-                hxyz[ia,ja] += order3(a, a1, A, B, e0, Hx, Hz, Hy)
-                hxyz[ia,ja] += order3(a, a1, A, B, e0, Hy, Hx, Hz)
-                hxyz[ia,ja] += order3(a, a1, A, B, e0, Hy, Hz, Hx)
-                hxyz[ia,ja] += order3(a, a1, A, B, e0, Hz, Hx, Hy)
-                hxyz[ia,ja] += order3(a, a1, A, B, e0, Hz, Hy, Hx)
-                
-                hxzz[ia,ja]  = order3(a, a1, A, B, e0, Hz, Hz, Hx)
-                hxzz[ia,ja] += order3(a, a1, A, B, e0, Hz, Hx, Hz)
-                hxzz[ia,ja] += order3(a, a1, A, B, e0, Hx, Hz, Hz)
-                
-                hyyz[ia,ja]  = order3(a, a1, A, B, e0, Hy, Hy, Hz)
-                hyyz[ia,ja] += order3(a, a1, A, B, e0, Hy, Hz, Hy)
-                hyyz[ia,ja] += order3(a, a1, A, B, e0, Hz, Hy, Hy)
-                
-                hyzz[ia,ja]  = order3(a, a1, A, B, e0, Hz, Hz, Hy)
-                hyzz[ia,ja] += order3(a, a1, A, B, e0, Hz, Hy, Hz)
-                hyzz[ia,ja] += order3(a, a1, A, B, e0, Hy, Hz, Hz)
-
-    # order 4   
-    hxxxx = np.zeros([NA,NA], dtype=complex)
-    hyyyy = np.zeros([NA,NA], dtype=complex)
-    hzzzz = np.zeros([NA,NA], dtype=complex)
-    hxxxy = np.zeros([NA,NA], dtype=complex)
-    hxxxz = np.zeros([NA,NA], dtype=complex)
-    hxyyy = np.zeros([NA,NA], dtype=complex)
-    hyyyz = np.zeros([NA,NA], dtype=complex)
-    hxzzz = np.zeros([NA,NA], dtype=complex)
-    hyzzz = np.zeros([NA,NA], dtype=complex)
-    hxxyy = np.zeros([NA,NA], dtype=complex)
-    hxxzz = np.zeros([NA,NA], dtype=complex)
-    hyyzz = np.zeros([NA,NA], dtype=complex)
-    hxxyz = np.zeros([NA,NA], dtype=complex)
-    hxyyz = np.zeros([NA,NA], dtype=complex)
-    hxyzz = np.zeros([NA,NA], dtype=complex)
+        if T3 is None:
+            T3 = order3_tensor(D, VAA, VAB, VBA, VBB)
+        h.update(tensor_to_monomials(T3, names))
     if maxorder >= 4:
-        for ia in range(NA):
-            for ja in range(NA):
-                a = A[ia]
-                a1 = A[ja]        
-
-                # (X+Y+Z)^4 = x^4 + y^4 + z^4 
-                #           + 4x^3y + 4x^3z + 4y^3x + 4y^3z + 4z^3x + 4z^3y 
-                #           + 6x^2y^2 + 6x^2z^2 + 6y^2z^2 
-                #           + 12x^2yz + 12y^2xz + 12z^2xy
-
-                # XXXX | YYYY | ZZZZ
-                hxxxx[ia,ja]  = order4(a, a1, A, B, e0, Hx, Hx, Hx, Hx)
-                hyyyy[ia,ja]  = order4(a, a1, A, B, e0, Hy, Hy, Hy, Hy)
-                hzzzz[ia,ja]  = order4(a, a1, A, B, e0, Hz, Hz, Hz, Hz)
-
-                # XXXY + XXYX + XYXX + YXXX
-                hxxxy[ia,ja]  = order4(a, a1, A, B, e0, Hx, Hx, Hx, Hy)
-                hxxxy[ia,ja] += order4(a, a1, A, B, e0, Hx, Hx, Hy, Hx)
-                hxxxy[ia,ja] += order4(a, a1, A, B, e0, Hx, Hy, Hx, Hx)
-                hxxxy[ia,ja] += order4(a, a1, A, B, e0, Hy, Hx, Hx, Hx)
-                
-                # XXXZ + XXZX + XZXX + ZXXX 
-                hxxxz[ia,ja]  = order4(a, a1, A, B, e0, Hx, Hx, Hx, Hz)
-                hxxxz[ia,ja] += order4(a, a1, A, B, e0, Hx, Hx, Hz, Hx)
-                hxxxz[ia,ja] += order4(a, a1, A, B, e0, Hx, Hz, Hx, Hx)
-                hxxxz[ia,ja] += order4(a, a1, A, B, e0, Hz, Hx, Hx, Hx)
-                
-                # YYYX + YYXY + YXYY + XYYY
-                hxyyy[ia,ja]  = order4(a, a1, A, B, e0, Hy, Hy, Hy, Hx)
-                hxyyy[ia,ja] += order4(a, a1, A, B, e0, Hy, Hy, Hx, Hy)
-                hxyyy[ia,ja] += order4(a, a1, A, B, e0, Hy, Hx, Hy, Hy)
-                hxyyy[ia,ja] += order4(a, a1, A, B, e0, Hx, Hy, Hy, Hy)
-                
-                # YYYZ + YYZY + YZYY + ZYYY
-                hyyyz[ia,ja]  = order4(a, a1, A, B, e0, Hy, Hy, Hy, Hz)
-                hyyyz[ia,ja] += order4(a, a1, A, B, e0, Hy, Hy, Hz, Hy)
-                hyyyz[ia,ja] += order4(a, a1, A, B, e0, Hy, Hz, Hy, Hy)
-                hyyyz[ia,ja] += order4(a, a1, A, B, e0, Hz, Hy, Hy, Hy)
-                
-                # ZZZX + ZZXZ + ZXZZ + XZZZ
-                hxzzz[ia,ja]  = order4(a, a1, A, B, e0, Hz, Hz, Hz, Hx)
-                hxzzz[ia,ja] += order4(a, a1, A, B, e0, Hz, Hz, Hx, Hz)
-                hxzzz[ia,ja] += order4(a, a1, A, B, e0, Hz, Hx, Hz, Hz)
-                hxzzz[ia,ja] += order4(a, a1, A, B, e0, Hx, Hz, Hz, Hz)
-                
-                # ZZZY + ZZYZ + ZYZZ + YZZZ
-                hyzzz[ia,ja]  = order4(a, a1, A, B, e0, Hz, Hz, Hz, Hy)
-                hyzzz[ia,ja] += order4(a, a1, A, B, e0, Hz, Hz, Hy, Hz)
-                hyzzz[ia,ja] += order4(a, a1, A, B, e0, Hz, Hy, Hz, Hz)
-                hyzzz[ia,ja] += order4(a, a1, A, B, e0, Hy, Hz, Hz, Hz)
-                
-                # XXYY + XYYX + YYXX + YXXY + XYXY + YXYX
-                hxxyy[ia,ja]  = order4(a, a1, A, B, e0, Hx, Hx, Hy, Hy)
-                hxxyy[ia,ja] += order4(a, a1, A, B, e0, Hx, Hy, Hy, Hx)
-                hxxyy[ia,ja] += order4(a, a1, A, B, e0, Hy, Hy, Hx, Hx)
-                hxxyy[ia,ja] += order4(a, a1, A, B, e0, Hy, Hx, Hx, Hy)
-                hxxyy[ia,ja] += order4(a, a1, A, B, e0, Hx, Hy, Hx, Hy)
-                hxxyy[ia,ja] += order4(a, a1, A, B, e0, Hy, Hx, Hy, Hx)
-                
-                # XXZZ + XZZX + ZZXX + ZXXZ + XZXZ + ZXZX
-                hxxzz[ia,ja]  = order4(a, a1, A, B, e0, Hx, Hx, Hz, Hz)
-                hxxzz[ia,ja] += order4(a, a1, A, B, e0, Hx, Hz, Hz, Hx)
-                hxxzz[ia,ja] += order4(a, a1, A, B, e0, Hz, Hz, Hx, Hx)
-                hxxzz[ia,ja] += order4(a, a1, A, B, e0, Hz, Hx, Hx, Hz)
-                hxxzz[ia,ja] += order4(a, a1, A, B, e0, Hx, Hz, Hx, Hz)
-                hxxzz[ia,ja] += order4(a, a1, A, B, e0, Hz, Hx, Hz, Hx)
-                
-                # YYZZ + YZZY + ZZYY + ZYYZ + YZYZ + ZYZY
-                hyyzz[ia,ja]  = order4(a, a1, A, B, e0, Hy, Hy, Hz, Hz)
-                hyyzz[ia,ja] += order4(a, a1, A, B, e0, Hy, Hz, Hz, Hy)
-                hyyzz[ia,ja] += order4(a, a1, A, B, e0, Hz, Hz, Hy, Hy)
-                hyyzz[ia,ja] += order4(a, a1, A, B, e0, Hz, Hy, Hy, Hz)
-                hyyzz[ia,ja] += order4(a, a1, A, B, e0, Hy, Hz, Hy, Hz)
-                hyyzz[ia,ja] += order4(a, a1, A, B, e0, Hz, Hy, Hz, Hy)
-                
-                # (XXYZ + XYZX + YZXX + YXXZ + XYXZ + YXZX) + (XXZY + XZYX + ZYXX + ZXXY + XZXY + ZXYX)
-                hxxyz[ia,ja]  = order4(a, a1, A, B, e0, Hx, Hx, Hy, Hz)
-                hxxyz[ia,ja] += order4(a, a1, A, B, e0, Hx, Hy, Hz, Hx)
-                hxxyz[ia,ja] += order4(a, a1, A, B, e0, Hy, Hz, Hx, Hx)
-                hxxyz[ia,ja] += order4(a, a1, A, B, e0, Hy, Hx, Hx, Hz)
-                hxxyz[ia,ja] += order4(a, a1, A, B, e0, Hx, Hy, Hx, Hz)
-                hxxyz[ia,ja] += order4(a, a1, A, B, e0, Hy, Hx, Hz, Hx)
-                hxxyz[ia,ja] += order4(a, a1, A, B, e0, Hx, Hx, Hz, Hy)
-                hxxyz[ia,ja] += order4(a, a1, A, B, e0, Hx, Hz, Hy, Hx)
-                hxxyz[ia,ja] += order4(a, a1, A, B, e0, Hz, Hy, Hx, Hx)
-                hxxyz[ia,ja] += order4(a, a1, A, B, e0, Hz, Hx, Hx, Hy)
-                hxxyz[ia,ja] += order4(a, a1, A, B, e0, Hx, Hz, Hx, Hy)
-                hxxyz[ia,ja] += order4(a, a1, A, B, e0, Hz, Hx, Hy, Hx)
-                
-                # (YYXZ + YXZY + XZYY + XYYZ + YXYZ + XYZY) + (YYZX + YZXY + ZXYY + ZYYX + YZYX + ZYXY)
-                hxyyz[ia,ja]  = order4(a, a1, A, B, e0, Hy, Hy, Hx, Hz)
-                hxyyz[ia,ja] += order4(a, a1, A, B, e0, Hy, Hx, Hz, Hy)
-                hxyyz[ia,ja] += order4(a, a1, A, B, e0, Hx, Hz, Hy, Hy)
-                hxyyz[ia,ja] += order4(a, a1, A, B, e0, Hx, Hy, Hy, Hz)
-                hxyyz[ia,ja] += order4(a, a1, A, B, e0, Hy, Hx, Hy, Hz)
-                hxyyz[ia,ja] += order4(a, a1, A, B, e0, Hx, Hy, Hz, Hy)
-                hxyyz[ia,ja] += order4(a, a1, A, B, e0, Hy, Hy, Hz, Hx)
-                hxyyz[ia,ja] += order4(a, a1, A, B, e0, Hy, Hz, Hx, Hy)
-                hxyyz[ia,ja] += order4(a, a1, A, B, e0, Hz, Hx, Hy, Hy)
-                hxyyz[ia,ja] += order4(a, a1, A, B, e0, Hz, Hy, Hy, Hx)
-                hxyyz[ia,ja] += order4(a, a1, A, B, e0, Hy, Hz, Hy, Hx)
-                hxyyz[ia,ja] += order4(a, a1, A, B, e0, Hz, Hy, Hx, Hy)
-                
-                # (ZZXY + ZXYZ + XYZZ + XZZY + XZYZ + ZXZY) + (ZZYX + ZYXZ + YXZZ + YZZX + YZXZ + ZYZX)
-                hxyzz[ia,ja]  = order4(a, a1, A, B, e0, Hz, Hz, Hx, Hy)
-                hxyzz[ia,ja] += order4(a, a1, A, B, e0, Hz, Hx, Hy, Hz)
-                hxyzz[ia,ja] += order4(a, a1, A, B, e0, Hx, Hy, Hz, Hz)
-                hxyzz[ia,ja] += order4(a, a1, A, B, e0, Hx, Hz, Hz, Hy)
-                hxyzz[ia,ja] += order4(a, a1, A, B, e0, Hx, Hz, Hy, Hz)
-                hxyzz[ia,ja] += order4(a, a1, A, B, e0, Hz, Hx, Hz, Hy)                        
-                hxyzz[ia,ja] += order4(a, a1, A, B, e0, Hz, Hz, Hy, Hx)
-                hxyzz[ia,ja] += order4(a, a1, A, B, e0, Hz, Hy, Hx, Hz)
-                hxyzz[ia,ja] += order4(a, a1, A, B, e0, Hy, Hx, Hz, Hz)
-                hxyzz[ia,ja] += order4(a, a1, A, B, e0, Hy, Hz, Hz, Hx)
-                hxyzz[ia,ja] += order4(a, a1, A, B, e0, Hy, Hz, Hx, Hz)
-                hxyzz[ia,ja] += order4(a, a1, A, B, e0, Hz, Hy, Hz, Hx)
-            
-    # return as a dictionary
-    h = {}
-    # order 0
-    h[0] = h0
-    # order 1
-    h['x'] = hx
-    h['y'] = hy
-    h['z'] = hz
-    # order 2
-    h['xx'] = hxx + np.eye(hxx.shape[0])
-    h['xy'] = hxy
-    h['xz'] = hxz
-    h['yy'] = hyy + np.eye(hyy.shape[0])
-    h['yz'] = hyz
-    h['zz'] = hzz + np.eye(hzz.shape[0])
-    # order 3
-    h['xxx'] = hxxx
-    h['yyy'] = hyyy
-    h['zzz'] = hzzz
-    h['xxy'] = hxxy
-    h['xxz'] = hxxz
-    h['xyy'] = hxyy
-    h['xyz'] = hxyz
-    h['xzz'] = hxzz
-    h['yyz'] = hyyz
-    h['yzz'] = hyzz
-    # order 4
-    h['xxxx'] = hxxxx
-    h['yyyy'] = hyyyy
-    h['zzzz'] = hzzzz
-    h['xxxy'] = hxxxy
-    h['xxxz'] = hxxxz
-    h['xyyy'] = hxyyy
-    h['yyyz'] = hyyyz
-    h['xzzz'] = hxzzz
-    h['yzzz'] = hyzzz
-    h['xxyy'] = hxxyy
-    h['xxzz'] = hxxzz
-    h['yyzz'] = hyyzz
-    h['xxyz'] = hxxyz
-    h['xyyz'] = hxyyz
-    h['xyzz'] = hxyzz
+        if T4 is None:
+            T4 = order4_tensor(D, VAA, VAB, VBA, VBB)
+        h.update(tensor_to_monomials(T4, names))
+    # high orders: generic engine, with one character per field as labels
+    if maxorder > 4:
+        labels = ''.join(chr(256+n) for n in range(len(names)))
+        hsw = schrieffer_wolff(A, H0, V, NB, maxorder, labels=labels, tol=tol)
+        for key, term in hsw.items():
+            if key != 0 and len(key) > 4:
+                h[tuple(names[labels.index(c)] for c in key)] = term
+    return h
+
+def H_of_fields(h):
+    '''
+    Builds a callable H(maxorder=None, **fields) from the result of fold_down(...).
+
+    Parameters
+    ----------
+    h : dict
+        Folded down terms, with keys 0 and tuples of field names.
+
+    Returns
+    -------
+    H(maxorder=None, **fields) : callable
+        Calculates h for the given values of the fields, e.g. H(x=0.01, Bz=0.1).
+        Missing fields are zero. If maxorder is given, higher terms are neglected.
+    '''
+    def H(maxorder=None, **fields):
+        out = h[0] + 0j
+        for key, term in h.items():
+            if key != 0 and (maxorder is None or len(key) <= maxorder):
+                f = np.prod([fields.get(name, 0) for name in key])
+                if f != 0:
+                    out = out + f*term
+        return out
+    return H
+
+class LazyHdict(Mapping):
+    '''
+    Folded down h, as in lowdin(...), calculated order by order on demand.
+
+    Each order is calculated the first time one of its keys is accessed,
+    e.g. by H_of_k(...) or basis_transform.get_coeffs(...), and memoized.
+    Keys of orders above maxorder return zero matrices, as in lowdin(...).
+    Raising maxorder later reuses the orders already calculated. Orders up
+    to 4 use the Löwdin tensors, and higher orders use schrieffer_wolff(...).
 
+    Parameters
+    ----------
+        A: int list/array
+            set of states considered as Löwdin's set A
+        H0: NxN array
+            Diagonal entries.
+        Hx, Hy, Hz: NxN array
+            Perturbation terms proportional to kx, ky, kz
+        NB: int
+            Number of bands in set B, above A
+        maxorder: int
+            Calculate the expansion up to this order
+        n_workers: int or None
+            Number of processes for orders 3 and 4, see lowdin(...)
+        tol: float or None
+            Screening tolerance for set B, see lowdin(...)
+        verbose: bool
+            If True, prints the reports of the screening and of the sparsity
+        multiplets: list of lists or None
+            Degenerate multiplets for the block-sparse V, see lowdin(...)
+        cache: fold_down_cache, bool or None
+            On-disk cache, with one entry per order. If True, uses a
+            fold_down_cache with default settings.
+        dims: str, tuple or None
+            Active directions of the momentum, e.g. ('x', 'y') for 2D
+            systems or 'z' for wires. Only the monomials in these
+            directions are calculated, and the other keys return zeros.
+            Defaults to None, all directions.
+        checkpoint: str, checkpoint or None
+            Checkpoint file. Each order is written to it as soon as it is
+            calculated, and a new LazyHdict with the same inputs resumes
+            from the orders stored there. Orders 3 and 4 are also written
+            after each work item, the pairs of order4_pairs(...) and each
+            block of rows of set A times a direction, see parallel_tensors(...),
+            so an interrupted order 4 resumes from its finished items.
+            Defaults to None (no checkpoint).
+
+    Attributes
+    ----------
+        maxorder: int
+            Keys above this order return zeros. May be changed at any time.
+        options: tuple
+            The inputs (A, NB, tol, multiplets, dims) that define the set B and V.
+        B: array
+            Band indices of set B, after the screening if tol is given.
+    '''
+    def __init__(self, A, H0, Hx, Hy, Hz, NB=None, maxorder=2, n_workers=None, 
+                 tol=None, verbose=False, multiplets=None, cache=None, dims=None,
+                 checkpoint=None):
+        self.A = np.array(A)
+        self.H0 = H0
+        self.dims = active_dims(dims)
+        self.V = np.array([Hx, Hy, Hz])[['xyz'.index(c) for c in self.dims]]
+        self.NB = NB
+        self.maxorder = maxorder
+        self.n_workers = n_workers
+        self.tol = tol
+        self.verbose = verbose
+        self.multiplets = multiplets
+        self.cache = fold_down_cache() if cache is True else cache
+        self.checkpoint = as_checkpoint(checkpoint)
+        self.options = (tuple(self.A), NB, tol, repr(multiplets), self.dims)
+        self.orders = {} # memoized orders
+        self.parts = {} # finished work items of orders 3 and 4
+        self.setup = None
+        self.cachekey = None
+        self.resumed = False
+
+    def _keys(self, order):
+        return monomial_keys(order)
+
+    def __iter__(self):
+        for order in range(max(4, self.maxorder)+1):
+            yield from self._keys(order)
+
+    def __len__(self):
+        return sum(len(self._keys(order)) for order in range(max(4, self.maxorder)+1))
+
+    def _order(self, key):
+        # power of k of a valid key, or None
+        if isinstance(key, str) and key in self._keys(len(key)):
+            return len(key)
+        return 0 if key == 0 and not isinstance(key, bool) else None
+
+    def __contains__(self, key):
+        # does not trigger the calculation of the order
+        order = self._order(key)
+        return order is not None and order <= max(4, self.maxorder)
+
+    def __getitem__(self, key):
+        order = self._order(key)
+        if order is None:
+            raise KeyError(key)
+        if order > self.maxorder or key != 0 and not set(key) <= set(self.dims):
+            return np.zeros([len(self.A)]*2, dtype=complex)
+        if order not in self.orders:
+            self.orders.update(self.calculate(order))
+        return self.orders[order][key]
+
+    @property
+    def B(self):
+        '''
+        Band indices of set B, after the screening if tol is given.
+        '''
+        return self._setup()[0]
+
+    def _setup(self):
+        # blocks and denominators shared by all orders, built once
+        if self.setup is None:
+            self.setup = prepare_blocks(self.A, self.H0, self.V, self.NB, self.tol, 
+                                        self.multiplets, self.verbose)
+        return self.setup
+
+    def calculate(self, order):
+        '''
+        Calculates an order, or loads it from the checkpoint or the cache.
+
+        Parameters
+        ----------
+            order: int
+                The power of k.
+
+        Returns
+        -------
+            dict
+                {order: {key: matrix}}, possibly with other orders
+                calculated along with it.
+        '''
+        if self.cachekey is None:
+            self.cachekey = hash_inputs(np.diag(self.H0), self.V, self.A, self.NB, 
+                                        self.tol, repr(self.multiplets), self.dims)
+        if self.checkpoint and not self.resumed:
+            self.resumed = True
+            self.orders.update(self.resume())
+            if order in self.orders:
+                return {order: self.orders[order]}
+        if self.cache:
+            key = self.cache.key(self.cachekey, order)
+            h = self.cache.load(key)
+            if h is not None:
+                return self.save({order: h})
+        orders = self._calculate(order)
+        if self.cache:
+            for n, h in orders.items():
+                self.cache.store(self.cache.key(self.cachekey, n), h)
+        return self.save(orders)
+
+    def resume(self):
+        # orders stored in the checkpoint by a previous run with the same inputs
+        data = self.checkpoint.load(self.cachekey)
+        if data is None:
+            return {}
+        orders = {}
+        parts = {}
+        for name, matrix in data.items():
+            n, key = name.split(':')
+            if n == 'part':
+                # item:index of a work item of orders 3 and 4
+                item, i = key.rsplit('.', 1)
+                parts.setdefault(item, {})[int(i)] = matrix
+            else:
+                orders.setdefault(int(n), {})[0 if key == '0' else key] = matrix
+        self.parts = {item: [h[i] for i in sorted(h)] for item, h in parts.items()}
+        if self.verbose:
+            print(f'Resuming orders {sorted(orders)} and {len(self.parts)} work items '
+                  f'from {self.checkpoint.path}')
+        return orders
+
+    def save(self, orders):
+        # writes the completed orders and work items to the checkpoint
+        if self.checkpoint:
+            completed = {**self.orders, **orders}
+            data = {f'{n}:{key}': matrix for n, h in completed.items() for key, matrix in h.items()}
+            data.update({f'part:{item}.{i}': x for item, h in self.parts.items() 
+                         for i, x in enumerate(h)})
+            self.checkpoint.store(self.cachekey, data)
+        return orders
+
+    def save_part(self, item, arrays):
+        # writes a finished work item of orders 3 and 4 to the checkpoint
+        self.parts[item] = arrays
+        self.save({})
+
+    def _calculate(self, order):
+        A = self.A
+        NA = len(A)
+        if order == 0:
+            return {0: {0: self.H0[A,:][:,A]}}
+        if order > 4:
+            # high orders: generic engine, all orders up to maxorder at once
+            h = schrieffer_wolff(A, self.H0, self.V, self.NB, self.maxorder, labels=self.dims,
+                                 tol=self.tol, multiplets=self.multiplets)
+            return {n: {key: h[key] for key in monomial_keys(n, self.dims)} 
+                    for n in range(5, self.maxorder+1)}
+
+        B, e0, V, D, VAA, VAB, VBA, VBB = self._setup()
+
+        # order 1
+        if order == 1:
+            return {1: tensor_to_monomials(VAA, self.dims)}
+
+        # order 2
+        # (X+Y+Z)² = X² + Y² + Z² + (X.Y + Y.X) + (X.Z + Z.X) + (Y.Z + Z.Y)
+        if order == 2:
+            h = tensor_to_monomials(order2_tensor(D, VAB, VBA), self.dims)
+            # k² from H = H0 + 2k.p + k²
+            for c in self.dims:
+                h[c+c] = h[c+c] + np.eye(NA)
+            return {2: h}
+
+        # orders 3 and 4 on a process pool, or checkpointed by work items, both at once
+        store = self.save_part if self.checkpoint else None
+        parallel = self.n_workers is not None and self.n_workers > 1
+        if parallel or self.checkpoint:
+            if parallel:
+                T3, T4 = parallel_tensors(A, B, e0, V, min(self.maxorder, 4), self.n_workers, 
+                                          sparse=self.multiplets is not None, 
+                                          done=self.parts, store=store)
+            else:
+                T3, T4 = serial_tensors(D, VAA, VAB, VBA, VBB, min(self.maxorder, 4), 
+                                        self.parts, store)
+            # the work items are replaced by the completed orders
+            self.parts = {}
+            h = {3: tensor_to_monomials(T3, self.dims)}
+            if T4 is not None:
+                h[4] = tensor_to_monomials(T4, self.dims)
+            return h
+
+        # order 3
+        # (X+Y+Z)³ = X³ + Y³ + Z³ + XXY + XYX + YXX + ... + YZZ + ZYZ + ZZY
+        if order == 3:
+            return {3: tensor_to_monomials(order3_tensor(D, VAA, VAB, VBA, VBB), self.dims)}
+
+        # order 4
+        # (X+Y+Z)^4 = x^4 + y^4 + z^4 
+        #           + 4x^3y + 4x^3z + 4y^3x + 4y^3z + 4z^3x + 4z^3y 
+        #           + 6x^2y^2 + 6x^2z^2 + 6y^2z^2 
+        #           + 12x^2yz + 12y^2xz + 12z^2xy
+        return {4: tensor_to_monomials(order4_tensor(D, VAA, VAB, VBA, VBB), self.dims)}
+
+
+def numerical_fold_down(A, H0, Hx, Hy, Hz, maxorder=4, kmax=None, fitorder=None, dims=None, 
+                        chunk=32):
+    '''
+    Folds down H into the selected setA numerically, from the exact
+    eigenstates of H(k) = H0 + kx Hx + ky Hy + kz Hz + k² on a stencil of k points.
+
+    At each k, the set A states are projected with the direct rotation
+    (minimal rotation) gauge Psi = P P0 (P0 P P0)^(-1/2), where P and P0 are
+    the projectors onto set A at k and at k = 0. With the overlap
+    O = <A|set A states at k> = W S V† (SVD), this gives h(k) = Q E Q†,
+    with the polar factor Q = W V† and the eigenvalues E. The Taylor
+    coefficients of h(k) are then fitted by least squares. This gauge is
+    the one of schrieffer_wolff(...), so both give the same model.
+
+    Parameters
+    ----------
+        A: int list/array
+            set of states considered as Löwdin's set A
+        H0: NxN array
+            Diagonal entries.
+        Hx, Hy, Hz: NxN array
+            Perturbation terms proportional to kx, ky, kz
+        maxorder: int
+            Calculate the expansion up to this order
+        kmax: float or None
+            Size of the stencil. Defaults to 0.2 gap/(max|<A|V|B>| + max||<A|V|A>||),
+            a fifth of the estimated radius of convergence of the expansion,
+            reduced by the spread of the set A bands within the stencil.
+        fitorder: int or None
+            Order of the fitted polynomial. The terms above maxorder absorb
+            the truncation error of the fit. Defaults to maxorder + 4.
+            Together with kmax, it balances the truncation error of the fit
+            and the round-off error of the eigenvalues.
+        dims: str, tuple or None
+            Active directions of the momentum, see LazyHdict(...).
+        chunk: int
+            Number of k points diagonalized in each batched call.
+
+    Returns
+    -------
+        h : dict
+            folded down h = h0 + hx.kx + hy.ky + hz.kz + hxx.kx² + hxy.kx.ky + ...
+            in the same format as lowdin(...), including the k² term.
+
+    Notes
+    -----
+    At each k, the set A states are the NA eigenstates with the largest
+    weight on the set A states at k = 0, so the bands of set A may cross
+    each other, or the bands of set B, within the stencil. An exception is
+    raised if any of these weights is below 1/2, as set A is then not
+    separated from set B and kmax must be reduced.
+    '''
+    A = np.array(A)
+    NA = len(A)
+    N = len(H0)
+    dims = active_dims(dims)
+    V = np.array([Hx, Hy, Hz])[['xyz'.index(c) for c in dims]]
+    n = len(dims)
+    e0 = np.diag(H0)
+    if fitorder is None:
+        fitorder = maxorder + 4
+    if kmax is None:
+        B = define_set_B(N, A)
+        gap = np.abs(e0[A][:,None] - e0[B][None,:]).min()
+        VAA = V[:, A, :][:, :, A]
+        kmax = 0.2*gap/(np.abs(V[:, A, :][:, :, B]).max() + np.linalg.norm(VAA, 2, axis=(1,2)).max())
+
+    # stencil: integer points with |n|_1 <= r, in units of kmax/r
+    r = -(-fitorder//2) + 1
+    grid = np.array([p for p in np.ndindex(*(2*r+1,)*n)]) - r
+    grid = grid[np.abs(grid).sum(axis=1) <= r]
+    kpts = grid*kmax/r
+    # monomials up to fitorder at each k point, in units of kmax
+    exps = [m for order in range(fitorder+1) for m in monomials(order, n)]
+    M = np.array([[np.prod((k/kmax)**np.array(m)) for m in exps] for k in kpts])
+    if np.linalg.matrix_rank(M) < len(exps):
+        raise Exception('The stencil does not determine all monomials.')
+
+    # h(k) at each k point, in chunks of batched diagonalizations
+    hk = np.zeros((len(kpts), NA, NA), dtype=complex)
+    for start in range(0, len(kpts), chunk):
+        ks = kpts[start:start+chunk]
+        H = H0[None] + np.einsum('si,inm->snm', ks, V)
+        H += (ks**2).sum(axis=1)[:,None,None]*np.eye(N)
+        E, U = np.linalg.eigh(H)
+        # states of set A: largest weights on the set A states at k = 0
+        weights = np.sum(np.abs(U[:, A, :])**2, axis=1)
+        idx = np.sort(np.argsort(-weights, axis=1)[:, :NA], axis=1)
+        if np.take_along_axis(weights, idx, axis=1).min() < 0.5:
+            raise Exception('The set A states mix with set B within the stencil, reduce kmax.')
+        E = np.take_along_axis(E, idx, axis=1)
+        O = np.take_along_axis(U[:, A, :], idx[:, None, :], axis=2)
+        W, _, Vh = np.linalg.svd(O)
+        Q = W @ Vh
+        hk[start:start+chunk] = (Q*E[:,None,:]) @ Q.conj().transpose(0,2,1)
+
+    # least squares fit of all coefficients at once
+    coeffs = np.linalg.lstsq(M, hk.reshape(len(kpts), -1), rcond=None)[0]
+    coeffs = coeffs.reshape(len(exps), NA, NA)
+    coeffs /= kmax**np.array([sum(m) for m in exps])[:,None,None]
+
+    # same keys as lowdin(...), the inactive directions are zero
+    h = {key: np.zeros([NA,NA], dtype=complex) 
+         for order in range(1, max(4, maxorder)+1) for key in monomial_keys(order)}
+    for m, c in zip(exps, coeffs):
+        if sum(m) <= maxorder:
+            key = monomial_key(m, dims)
+            # h is Hermitian by construction, remove the noise of the fit
+            h[key] = 0.5*(c + c.conj().T)
+    h[0] = h[0].real
+    return h
+
+def estimate_truncation_error(h, kmax, e0, V, A, B, maxorder, dims=None):
+    '''
+    Estimates the norm of the next-order contribution of the fold-down,
+    from the orders already calculated and from the smallest A-B gap.
+
+    The norm of the order n contribution over the sphere |k| <= kmax is
+    measured by E_n = sum_m ||h[m]|| kmax^n, summed over the monomials m of
+    order n in the active directions (the exact k² term is excluded). Each
+    new order adds one factor k.V and one energy denominator to the terms,
+    so the ratio between consecutive orders is estimated by
+
+        rho = kmax (||V_AA|| + ||V_AB|| + ||V_BB||) / min|e_a - e_b|,
+
+    with the spectral norms of the blocks of V (all directions combined).
+    The next-order contribution is estimated as E_n max(rho, E_n/E_(n-1)),
+    where the ratio of the calculated orders covers the cases in which the
+    gap estimate is too optimistic. Order 0 depends on the choice of the
+    energy zero, so for n = 1 only rho is used.
+
+    These are heuristic estimates of the size of the neglected terms, not
+    rigorous bounds.
+
+    Parameters
+    ----------
+        h: dict
+            Folded down terms, as from lowdin(...) or LazyHdict(...).
+            Only the orders up to maxorder are accessed.
+        kmax: float
+            Radius of the k region of interest.
+        e0: array
+            Eigenvalues.
+        V: array, shape (n, N, N)
+            Stacked perturbations of the active directions, e.g. [Hx, Hy, Hz].
+        A, B: array
+            Band indices of sets A and B.
+        maxorder: int
+            Highest order already calculated.
+        dims: str, tuple or None
+            Active directions of the momentum, see LazyHdict(...).
+
+    Returns
+    -------
+        errors: dict
+            errors[n] is the estimated norm of the order n+1 contribution,
+            i.e. the truncation error of the model up to order n, for
+            n = 1, ..., maxorder.
+        norms: dict
+            norms[n] is the estimate E_n of the order n contribution,
+            for n = 1, ..., maxorder.
+    '''
+    A = np.array(A)
+    B = np.array(B)
+    NA = len(A)
+    dims = active_dims(dims)
+    norms = {}
+    for n in range(1, maxorder+1):
+        E = 0
+        for key in monomial_keys(n, dims):
+            term = h[key]
+            if n == 2 and key[0] == key[1]:
+                # k² from H = H0 + 2k.p + k² is exact
+                term = term - np.eye(NA)
+            E += np.linalg.norm(term, 2)*kmax**n
+        norms[n] = E
+
+    # spectral norms of the blocks, combined over the directions
+    def norm(X):
+        if min(X.shape) == 0:
+            return 0.0
+        if min(X.shape) <= 2 or X.shape[0] != X.shape[1]:
+            return np.linalg.norm(X, 2)
+        return np.abs(eigsh(X, k=1, which='LM', return_eigenvectors=False)).max()
+    VAA, VAB, VBA, VBB = blocks(V, A, B)
+    v = sum(np.sqrt(sum(norm(Xi)**2 for Xi in X)) for X in (VAA, VAB, VBB))
+    gap = np.abs(e0[A][:,None] - e0[B][None,:]).min()
+    rho = kmax*v/gap
+
+    errors = {}
+    for n in range(1, maxorder+1):
+        ratio = norms[n]/norms[n-1] if n > 1 and norms[n-1] > 0 else 0
+        errors[n] = norms[n]*max(rho, ratio)
+    return errors, norms
+
+def scan_remote_bands(A, H0, Hx, Hy, Hz, NBs):
+    '''
+    Folds down H into the selected setA up to order 2 for several sizes of
+    set B at once.
+
+    The second-order terms are sums over the bands in set B, so the
+    contributions of the bands above set A are accumulated in chunks between
+    consecutive values of NB. The total cost is the cost of a single
+    fold-down with NB = max(NBs).
+
+    Parameters
+    ----------
+        A: int list/array
+            set of states considered as Löwdin's set A
+        H0: NxN array
+            Diagonal entries.
+        Hx, Hy, Hz: NxN array
+            Perturbation terms proportional to kx, ky, kz
+        NBs: int list/array
+            Numbers of bands in set B, above A
+
+    Returns
+    -------
+        h : dict
+            Same keys as lowdin(...) with maxorder=2, where each entry is an
+            array of shape (len(NBs), NA, NA) with one matrix per NB.
+            Terms of order 3 and 4 are set to zero.
+    '''
+    N = len(H0)
+    NA = len(A)
+    A = np.array(A)
+    NBs = np.array(NBs)
+    e0 = np.diag(H0)
+    V = np.array([Hx, Hy, Hz])
+    # h0 and h1 do not depend on NB
+    h = lowdin(A, H0, Hx, Hy, Hz, NB=0, maxorder=1)
+    h = {key: np.repeat(h[key][None], len(NBs), axis=0) for key in h}
+    # bands below A, common to all NB, and bands above A, in order
+    below = define_set_B(N, A, 0)
+    above = np.arange(A[-1]+1, N)
+
+    # second order terms accumulated chunk by chunk
+    def chunk(S):
+        D = energy_denominators(e0, A, S)
+        _, VAB, VBA, _ = blocks(V, A, S)
+        return tensor_to_monomials(order2_tensor(D, VAB, VBA))
+    acc = chunk(below)
+    # k² from H = H0 + 2k.p + k²
+    for c in 'xyz':
+        acc[c+c] = acc[c+c] + np.eye(NA)
+    last = 0
+    for n in np.argsort(NBs):
+        nb = min(NBs[n], len(above))
+        if nb > last:
+            for key, term in chunk(above[last:nb]).items():
+                acc[key] = acc[key] + term
+            last = nb
+        for key, term in acc.items():
+            h[key][n] += term
+    return h
+
+def monomials(order, nvar=3):
+    """
+    Lists the exponents of all monomials of a given total order.
+
+    Parameters
+    ----------
+    order : int
+        Total power of the monomials.
+    nvar : int, optional
+        Number of variables. Defaults to 3, for (kx, ky, kz).
+
+    Returns
+    -------
+    list of tuples
+        Exponents (nx, ny, ...) in the same order as the keys of
+        constants.DFTkeys, e.g. (2,0,0), (1,1,0), (1,0,1), (0,2,0), ...
+    """
+    if nvar == 1:
+        return [(order,)]
+    return [(n,) + m for n in range(order, -1, -1) for m in monomials(order-n, nvar-1)]
+
+def monomial_key(m, labels='xyz'):
+    """
+    Converts the exponents of a monomial into its dict key,
+    e.g. (2,1,0) into 'xxy', and (0,0,0) into 0.
+    """
+    key = ''.join(labels[i]*n for i, n in enumerate(m))
+    return key if key != '' else 0
+
+def active_dims(dims=None):
+    """
+    Normalizes the active directions of the momentum into a string in the
+    order of 'xyz', e.g. ('y', 'x') into 'xy', and None into 'xyz'.
+    """
+    return ''.join(c for c in 'xyz' if dims is None or c in dims)
+
+@lru_cache(maxsize=None)
+def monomial_keys(order, labels='xyz'):
+    """
+    Lists the keys of all monomials of a given total order, e.g. 
+    ('xx', 'xy', 'xz', 'yy', 'yz', 'zz'), and (0,) for order 0.
+    """
+    return tuple(monomial_key(m, labels) for m in monomials(order, len(labels)))
+
+def _splits(m, nonzero=True):
+    """
+    Lists all pairs of exponents (p, q) with p + q = m. If nonzero is True,
+    pairs where p or q is zero are excluded.
+    """
+    pairs = []
+    for p in np.ndindex(*[n+1 for n in m]):
+        q = tuple(n - i for n, i in zip(m, p))
+        if (sum(p) > 0 and sum(q) > 0) or not nonzero:
+            pairs.append((p, q))
+    return pairs
+
+def _convolve(S1, S2, m, nonzero=True):
+    """
+    Returns the term of order m in the product of two matrix series,
+    sum_{p+q=m} S1[p] @ S2[q].
+    """
+    return sum(S1[p] @ S2[q] for p, q in _splits(m, nonzero))
+
+def schrieffer_wolff(A, H0, Hs, NB=None, maxorder=6, labels='xyz', tol=None, verbose=False,
+                     multiplets=None):
+    '''
+    Folds down H into the selected setA up to an arbitrary order, using
+    a recursive Schrieffer-Wolff generator.
+
+    The perturbed set A spans the subspace [1; X] of H = H0 + sum_i k_i Hs[i],
+    where the N_B x N_A generator X solves the Riccati equation
+    H_BA + H_BB X = X (H_AA + H_AB X). It is built order by order, with each
+    new term obtained by an elementwise division by the energy denominators.
+    The Schrieffer-Wolff (minimal rotation) basis is then
+    Psi = [1; X] G^(-1/2), with G = 1 + X†X, and the effective Hamiltonian
+    reads h = Psi† H Psi = G^(1/2) (H_AA + H_AB X) G^(-1/2).
+
+    All series are kept as commutative polynomials in the momentum, so the
+    number of terms grows polynomially with the order. Only blocks of sizes
+    N_B x N_A and N_A x N_A are stored. Up to order 4, the results match
+    lowdin(...).
+
+    Parameters
+    ----------
+        A: int list/array
+            set of states considered as Löwdin's set A
+        H0: NxN array
+            Diagonal entries.
+        Hs: list of NxN arrays
+            Perturbation terms proportional to each component of k.
+        NB: int
+            Number of bands in set B, above A
+        maxorder: int
+            Calculate the expansion up to this order
+        labels: str
+            Label of each perturbation, used to build the dict keys.
+        tol: float or None
+            If given, drops the bands of set B whose contributions are
+            below tol, see screen_remote_bands(...)
+        verbose: bool
+            If True, prints the reports of the screening and of the sparsity
+        multiplets: list of lists or None
+            Band indices of the degenerate multiplets. If given, the blocks
+            forbidden by symmetry are skipped, see block_sparse(...)
+
+    Returns
+    -------
+        h : dict
+            folded down h = h0 + hx.kx + hy.ky + hz.kz + hxx.kx² + hxy.kx.ky + ...
+            with keys for all monomials up to maxorder.
+    '''
+    N = len(H0)
+    NA = len(A)
+    nvar = len(Hs)
+    A = np.array(A)
+    B = define_set_B(N, A, NB)
+    e0 = np.diag(H0)
+    Hs = np.array(Hs)
+
+    # skip the blocks forbidden by symmetry
+    if multiplets is not None:
+        Hs, stats = block_sparse(Hs, multiplets)
+
+    # drop the remote bands with negligible contributions
+    if tol is not None:
+        B = screen_report(e0, Hs, A, B, tol, verbose)
+
+    # energy denominators and blocks of the perturbations
+    D = energy_denominators(e0, A, B)
+    HAA, HAB, HBA, HBB = blocks(Hs, A, B)
+    if multiplets is not None:
+        HBB = sparse_report(HBB, stats, verbose)
+
+    # series of X, M = H_AA + H_AB X, R = G^(1/2) and Q = G^(-1/2),
+    # as dicts with the exponents of k as keys
+    zero = (0,)*nvar
+    X = {zero: np.zeros([len(B), NA], dtype=complex)}
+    M = {zero: H0[A,:][:,A] + 0j}
+    R = {zero: np.eye(NA, dtype=complex)}
+    Q = {zero: np.eye(NA, dtype=complex)}
+    for order in range(1, maxorder+1):
+        for m in monomials(order, nvar):
+            rhs = np.zeros([len(B), NA], dtype=complex)
+            M[m] = np.zeros([NA, NA], dtype=complex)
+            for i in range(nvar):
+                if m[i] == 0:
+                    continue
+                # exponents of m / k_i
+                mi = tuple(n - int(j == i) for j, n in enumerate(m))
+                if order == 1:
+                    rhs -= HBA[i]
+                    M[m] += HAA[i]
+                else:
+                    rhs += X[mi] @ HAA[i] - HBB[i] @ X[mi]
+                    rhs += sum(X[p] @ (HAB[i] @ X[q]) for p, q in _splits(mi))
+                    M[m] += HAB[i] @ X[mi]
+            # generator: X[b,a] = rhs[b,a] / (e0[b] - e0[a])
+            X[m] = -rhs*D.T
+            # G = 1 + X†X, with R² = G and R.Q = 1
+            G = sum(X[p].T.conj() @ X[q] for p, q in _splits(m))
+            R[m] = 0.5*(G - _convolve(R, R, m)) + np.zeros([NA, NA])
+            Q[m] = -R[m] - _convolve(R, Q, m)
+
+    # effective Hamiltonian h = R M Q
+    RM = {}
+    h = {}
+    for order in range(maxorder+1):
+        for m in monomials(order, nvar):
+            RM[m] = _convolve(R, M, m, nonzero=False)
+            h[monomial_key(m, labels)] = _convolve(RM, Q, m, nonzero=False)
     return h
@@ -0,0 +1,398 @@
+'''
+Doc for the **pydft2kp/mesh.py** module.
+
+Evaluation of kp models on dense k meshes, e.g. for Fermi surfaces and
+constant energy contours. The mesh is generated in chunks, each chunk is
+diagonalized at once, and the results are written to memory-mapped npy
+files, so the memory use does not depend on the size of the mesh. With
+the point group at the expansion point, the mesh can be reduced to its
+irreducible wedge (kwedge), and the results unfolded back to the full mesh.
+'''
+
+import os
+import numpy as np
+from .cache import checkpoint, hash_inputs
+
+class kmesh():
+    '''
+    Regular k mesh, generated lazily in chunks.
+
+    Parameters
+    ----------
+    kx, ky, kz : array or float
+        The values of each component of k, e.g. np.linspace(-0.1, 0.1, 501),
+        or a single value for a fixed component (e.g. kz=0 for a 2D mesh).
+        In Bohr^-1, relative to the k point of the DFT data.
+
+    Attributes
+    ----------
+    axes : list of arrays
+        The values of kx, ky and kz.
+    shape : tuple
+        Number of values of kx, ky and kz.
+    size : int
+        Total number of k points.
+
+    Examples
+    --------
+    >>> k = np.linspace(-0.1, 0.1, 1001)
+    >>> mesh = kmesh(k, k, 0) # 2D mesh in the kz = 0 plane
+    >>> mesh.points(0, 5)     # the first 5 k points, shape (5, 3)
+    '''
+    def __init__(self, kx=0, ky=0, kz=0):
+        self.axes = [np.atleast_1d(np.asarray(ki, dtype=float)) for ki in (kx, ky, kz)]
+        self.shape = tuple(len(ki) for ki in self.axes)
+        self.size = int(np.prod(self.shape))
+
+    def points(self, start, stop):
+        '''
+        Returns the k points start, ..., stop-1 of the mesh (in C order),
+        with shape (stop-start, 3).
+        '''
+        return self.take(np.arange(start, min(stop, self.size)))
+
+    def take(self, indices):
+        '''
+        Returns the k points with the given (C order) indices, shape (len(indices), 3).
+        '''
+        idx = np.unravel_index(indices, self.shape)
+        return np.stack([ki[i] for ki, i in zip(self.axes, idx)], axis=1)
+
+    def fingerprint(self):
+        '''
+        Returns the arrays that identify the mesh, used to tag stored results.
+        '''
+        return self.axes
+
+    def chunks(self, chunk, start=0):
+        '''
+        Generates the mesh in chunks of k points.
+
+        Parameters
+        ----------
+        chunk : int
+            Number of k points in each chunk.
+        start : int, optional
+            Index of the first k point. Defaults to 0.
+
+        Yields
+        ------
+        start, stop, k :
+            The indices and the k points, shape (stop-start, 3), of each chunk.
+        '''
+        for i in range(start, self.size, chunk):
+            stop = min(i + chunk, self.size)
+            yield i, stop, self.points(i, stop)
+
+
+class kwedge(kmesh):
+    '''
+    Irreducible wedge of a k mesh under the point group at the expansion point.
+
+    Each k point of the mesh is mapped onto the representative of its star,
+    the image R k with the lowest index in the mesh. Only the representatives
+    are evaluated, and the results are unfolded back to the full mesh.
+
+    Parameters
+    ----------
+    mesh : kmesh
+        The full mesh. Its axes must be uniform (or have a single value).
+        The reduction is largest for meshes symmetric under the point group,
+        e.g. the same np.linspace(-a, a, n) for all axes of a cubic crystal.
+    ops : irrep, qsymm or list of arrays
+        The point group, see point_group_k(...).
+    tol : float, optional
+        Tolerance, in units of the mesh spacing, to identify the
+        images R k with the mesh points. Defaults to 1e-6.
+    chunk : int, optional
+        Number of k points processed at once while building the wedge.
+        Defaults to 2**20.
+
+    Attributes
+    ----------
+    mesh : kmesh
+        The full mesh.
+    ops : list of arrays
+        The 3x3 matrices R that act on k, with E(R k) = E(k).
+    kpoints : array
+        The k points of the wedge, shape (nwedge, 3).
+    weights : array
+        Number of mesh points represented by each k point of the wedge.
+        The sum of the weights is mesh.size.
+    index : array
+        Position in the wedge of the representative of each mesh point.
+    size, shape :
+        Number of k points in the wedge, as in kmesh, so that
+        evaluate_mesh(...) runs over the wedge only.
+
+    Examples
+    --------
+    >>> k = np.linspace(-0.1, 0.1, 201)
+    >>> wedge = kwedge(kmesh(k, k, k), kp)   # kp: irrep object
+    >>> print(wedge.mesh.size / wedge.size) # about 48 for Oh
+    >>> E, _ = evaluate_mesh(H, wedge, 'store')
+    >>> E = wedge.unfold(E)                 # shape (201, 201, 201, N)
+    '''
+    def __init__(self, mesh, ops, tol=1e-6, chunk=2**20):
+        self.mesh = mesh
+        self.ops = point_group_k(ops)
+        self.tol = tol
+        for ki in mesh.axes:
+            if len(ki) > 2 and not np.allclose(np.diff(ki), ki[1]-ki[0]):
+                raise Exception('kwedge requires uniform mesh axes.')
+        # representative of each mesh point
+        reps = np.empty(mesh.size, dtype=np.int64)
+        for start, stop, k in mesh.chunks(chunk):
+            rep = np.arange(start, stop)
+            for R in self.ops:
+                image = self.mesh_index(k @ R.T)
+                rep = np.where((image >= 0) & (image < rep), image, rep)
+            reps[start:stop] = rep
+        wedge, self.index, self.weights = np.unique(reps, return_inverse=True, 
+                                                    return_counts=True)
+        self.kpoints = mesh.take(wedge)
+        self.size = len(wedge)
+        self.shape = (self.size,)
+
+    def mesh_index(self, k):
+        '''
+        Returns the (C order) indices of the k points in the mesh,
+        or -1 for the points that are not in the mesh.
+        '''
+        index = np.zeros(len(k), dtype=np.int64)
+        valid = np.ones(len(k), dtype=bool)
+        for c, (ki, n) in enumerate(zip(self.mesh.axes, self.mesh.shape)):
+            if n == 1:
+                i = np.zeros(len(k), dtype=np.int64)
+                valid &= np.abs(k[:,c] - ki[0]) < self.tol
+            else:
+                x = (k[:,c] - ki[0]) / (ki[1] - ki[0])
+                i = np.rint(x).astype(np.int64)
+                valid &= (np.abs(x - i) < self.tol) & (i >= 0) & (i < n)
+            index = index*n + np.clip(i, 0, n-1)
+        return np.where(valid, index, -1)
+
+    def take(self, indices):
+        return self.kpoints[indices]
+
+    def fingerprint(self):
+        return self.mesh.fingerprint() + list(self.ops)
+
+    def unfold(self, values, out=None, chunk=2**20):
+        '''
+        Unfolds results on the wedge back to the full mesh.
+
+        Parameters
+        ----------
+        values : array
+            Results for each k point of the wedge, shape (nwedge, ...),
+            e.g. the energies from evaluate_mesh(...). They must be
+            invariant under the point group, as the energies are, while
+            e.g. the components of the eigenvectors are not.
+        out : array, optional
+            Array (or memmap) with shape mesh.shape + values.shape[1:]
+            for the result. Defaults to a new array.
+        chunk : int, optional
+            Number of mesh points unfolded at once. Defaults to 2**20.
+
+        Returns
+        -------
+        array
+            The results on the full mesh, shape mesh.shape + values.shape[1:].
+        '''
+        values = np.asarray(values) if not isinstance(values, np.memmap) else values
+        values = values.reshape((self.size,) + values.shape[1:])
+        if out is None:
+            out = np.empty(self.mesh.shape + values.shape[1:], dtype=values.dtype)
+        flat = out.reshape((self.mesh.size,) + values.shape[1:])
+        for start in range(0, self.mesh.size, chunk):
+            stop = min(start + chunk, self.mesh.size)
+            flat[start:stop] = values[self.index[start:stop]]
+        return out
+
+
+def point_group_k(source, time_reversal=None):
+    '''
+    Builds the point group that acts on k at the expansion point.
+
+    Parameters
+    ----------
+    source : irrep, qsymm or list of arrays
+        The irrep object (the little group of the k point in the DFT data),
+        the qsymm object (its symmetries, e.g. the generators), or a list
+        of 3x3 matrices R acting on k.
+    time_reversal : bool, optional
+        If True, adds k -> -k. Defaults to True for an irrep object with
+        anti-unitary symmetries (irrep.antiU), and False otherwise. The
+        anti-unitary symmetries of qsymm are always included, but not
+        its antisymmetries (chiral and particle-hole), which map E to -E.
+
+    Returns
+    -------
+    list of arrays
+        The 3x3 matrices R, in cartesian coordinates, with E(R k) = E(k).
+        The list is closed under multiplication, so generators are enough.
+    '''
+    if hasattr(source, 'bandstr'): # irrep
+        ops = []
+        for op in source.bandstr.kpoints[0].symmetries:
+            R = rotation_matrix(op.axis, op.angle)
+            ops += [-R if op.inversion else R]
+        if time_reversal is None:
+            time_reversal = len(source.antiU) > 0
+    elif hasattr(source, 'symms'): # qsymm
+        ops = []
+        for g in source.symms:
+            if g.antisymmetry:
+                # E -> -E, not a symmetry of the bands
+                continue
+            R = np.array(g.R, dtype=float)
+            R3 = np.eye(3)
+            # anti-unitary: k -> -R k
+            R3[:len(R),:len(R)] = -R if g.conjugate else R
+            ops += [R3]
+    else:
+        ops = [np.array(R, dtype=float) for R in source]
+    if time_reversal:
+        ops += [-np.eye(3)]
+    return close_group(ops)
+
+def rotation_matrix(axis, angle):
+    '''
+    Returns the 3x3 matrix of a rotation by angle (radians) around axis.
+    '''
+    n = np.array(axis, dtype=float) / np.linalg.norm(axis)
+    K = np.array([[0, -n[2], n[1]], [n[2], 0, -n[0]], [-n[1], n[0], 0]])
+    return np.eye(3) + np.sin(angle)*K + (1 - np.cos(angle))*K@K
+
+def close_group(ops):
+    '''
+    Completes a set of 3x3 matrices into the group they generate.
+    '''
+    group = {}
+    new = [np.eye(3)] + list(ops)
+    while new:
+        for R in new:
+            group.setdefault(tuple(np.round(R, 6).ravel()), R)
+        new = [R1 @ R2 for R1 in list(group.values()) for R2 in ops]
+        new = [R for R in new if tuple(np.round(R, 6).ravel()) not in group]
+    return list(group.values())
+
+
+def evaluate_mesh(H, mesh, path, bands=None, components=None, chunk=4096, resume=True,
+                  verbose=False):
+    '''
+    Calculates the bands of a kp model on a k mesh, chunk by chunk, and
+    streams them to memory-mapped npy files.
+
+    Parameters
+    ----------
+    H : callable
+        The model, as built by lowdin.H_of_k(...), irrep.build_H_of_k(...)
+        or basis_transform.Heff, accepting an (Nk, 3) array of k points.
+        Use a lambda to set other arguments, e.g.
+        lambda k: H(k, maxorder=4).
+    mesh : kmesh or kwedge
+        The k mesh, or its irreducible wedge. For a kwedge, the results
+        have shape (nwedge, ...), see kwedge.unfold(...).
+    path : str
+        Directory of the store. The files energies.npy (and vectors.npy)
+        and progress.npz are written there.
+    bands : list of int, optional
+        Indices of the bands to store. Defaults to all bands.
+    components : list of int, optional
+        If given, also stores these components of the eigenvectors of the
+        selected bands, e.g. the weights of some basis states. Not allowed
+        for a kwedge: the components transform under the representation of
+        the point group, so they cannot be unfolded as the energies.
+    chunk : int, optional
+        Number of k points diagonalized at once. The memory use is about
+        chunk*N*N complex numbers. Defaults to 4096.
+    resume : bool, optional
+        If True (default), a store with the same mesh, bands and components
+        is completed from where it stopped. Otherwise it is overwritten.
+    verbose : bool, optional
+        If True, prints the progress after each chunk.
+
+    Returns
+    -------
+    energies : memmap
+        The eigenvalues, shape mesh.shape + (nbands,).
+    vectors : memmap or None
+        The components of the eigenvectors, shape
+        mesh.shape + (ncomponents, nbands), if components is given.
+
+    Notes
+    -----
+    The progress is recorded after each chunk, once its results are
+    flushed to disk. The store does not know the model itself, so remove
+    it (or use resume=False) after changing the model.
+
+    Examples
+    --------
+    >>> H = kp.build_H_of_k()
+    >>> k = np.linspace(-0.1, 0.1, 2001)
+    >>> E, _ = evaluate_mesh(H, kmesh(k, k, 0), 'fermi_surface')
+    >>> plt.contour(k, k, E[:,:,0,1].T, levels=[0])
+    '''
+    if components is not None and isinstance(mesh, kwedge):
+        raise Exception('The eigenvector components cannot be unfolded from a kwedge, use the full kmesh.')
+    os.makedirs(path, exist_ok=True)
+    # size of the model
+    N = len(H(mesh.points(0, 1))[0])
+    bands = np.arange(N) if bands is None else np.asarray(bands)
+    shape = (mesh.size, len(bands))
+
+    progress = checkpoint(os.path.join(path, 'progress.npz'))
+    key = hash_inputs(*mesh.fingerprint(), bands, components, N)
+    stored = progress.load(key) if resume else None
+    if components is not None and not os.path.isfile(os.path.join(path, 'vectors.npy')):
+        stored = None
+    if not os.path.isfile(os.path.join(path, 'energies.npy')):
+        stored = None
+    mode = 'w+' if stored is None else 'r+'
+    done = 0 if stored is None else int(stored['done'])
+
+    energies = np.lib.format.open_memmap(os.path.join(path, 'energies.npy'), mode,
+                                         float, shape)
+    vectors = None
+    if components is not None:
+        vectors = np.lib.format.open_memmap(os.path.join(path, 'vectors.npy'), mode, complex,
+                                            (mesh.size, len(components), len(bands)))
+    if done > 0 and verbose:
+        print(f'Resuming from k point {done} of {mesh.size}')
+
+    for start, stop, k in mesh.chunks(chunk, done):
+        if components is None:
+            energies[start:stop] = np.linalg.eigvalsh(H(k))[:,bands]
+        else:
+            E, U = np.linalg.eigh(H(k))
+            energies[start:stop] = E[:,bands]
+            vectors[start:stop] = U[:,components][:,:,bands]
+            vectors.flush()
+        energies.flush()
+        progress.store(key, {'done': stop})
+        if verbose:
+            print(f'{stop} of {mesh.size} k points')
+
+    energies = energies.reshape(mesh.shape + (len(bands),))
+    if vectors is not None:
+        vectors = vectors.reshape(mesh.shape + (len(components), len(bands)))
+    return energies, vectors
+
+def load_mesh(path, mesh):
+    '''
+    Opens (read only) the results of evaluate_mesh(...) stored in path.
+
+    Returns
+    -------
+    energies, vectors :
+        As in evaluate_mesh(...). vectors is None if not stored.
+    '''
+    energies = np.load(os.path.join(path, 'energies.npy'), mmap_mode='r')
+    energies = energies.reshape(mesh.shape + energies.shape[1:])
+    vectors = None
+    if os.path.isfile(os.path.join(path, 'vectors.npy')):
+        vectors = np.load(os.path.join(path, 'vectors.npy'), mmap_mode='r')
+        vectors = vectors.reshape(mesh.shape + vectors.shape[1:])
+    return energies, vectors
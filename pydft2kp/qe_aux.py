@@ -2,7 +2,9 @@
 Doc for the **pydft2kp/qe_aux.py** module.
 '''
 
-from numpy import loadtxt, pi, array, where, fromstring, unique, argwhere, copy
+from numpy import loadtxt, pi, array, where, fromstring, unique, argwhere, copy, asarray, full, nan, arange, concatenate
+from numpy.linalg import eigvalsh, eigh
+from scipy.linalg import eigh as scipy_eigh
 import matplotlib.pyplot as plt
 import xml.etree.ElementTree as ET
 from .constants import Ry, a0
@@ -34,6 +36,8 @@ class qe_plotter:
         A 2D array with the energy levels for each band and each k-point.
     k3D : ndarray
         A 2D array with the Cartesian coordinates of the k-points.
+    results : dict
+        Energies (and eigenvectors) of the models stored by evaluate(...).
 
     Notes
     -----
@@ -90,6 +94,82 @@ class qe_plotter:
             self.k3D += [fromstring(each.text, sep=' ')]
         self.k3D = array(self.k3D) * 2*pi/alat # fix units
         self.k3D -= self.k3D[kpt-1] # shift central k to origin
+
+        # eigenvalues (and eigenvectors) of the models along the path,
+        # stored by evaluate(...)
+        self.results = {}
+
+    def evaluate(self, models, eigvecs=False, recompute=False, window=None, indices=None,
+                 verbose=False):
+        """
+        Calculates the bands of the models along the k path.
+
+        The Hamiltonians of each model are built for all k points as a
+        stacked (Nk, N, N) array, and diagonalized by a single batched
+        eigvalsh (or eigh) call. The results are stored in self.results,
+        so re-plotting or zooming does not recalculate them.
+
+        Parameters
+        ----------
+        models : dict
+            Callables H(kx, ky, kz) with the names of the models as keys,
+            e.g. {'full': H_crude_full, 'setA': H_crude_setA, 'optimal': optimal.Heff}.
+            Callables that accept an (Nk, 3) array of k points, as those
+            built by irrep.build_H_of_k(...), are evaluated at once. Other
+            callables are evaluated point by point.
+        eigvecs : bool, optional
+            If True, also returns the eigenvectors. Defaults to False.
+        recompute : bool, optional
+            If True, ignores the stored results. Defaults to False.
+        window : tuple (emin, emax), optional
+            If given, only the eigenvalues inside this energy window (in Ry)
+            are calculated, point by point, see partial_spectrum(...).
+            Useful for the full crude model with hundreds of bands.
+        indices : tuple (first, last), optional
+            If given, only the eigenpairs first, ..., last are calculated,
+            see partial_spectrum(...).
+        verbose : bool, optional
+            If True, prints how much work the window saved.
+
+        Returns
+        -------
+        dict
+            For each model, the energies with shape (Nk, N), or a tuple with
+            the energies and the eigenvectors, shape (Nk, N, N), if eigvecs
+            is True.
+
+        Notes
+        -----
+        A stored result is reused if the name, the callable of the model and
+        the window are the same as in the previous call. A new callable, e.g.
+        after rebuilding the model, is always recalculated.
+
+        Examples
+        --------
+        >>> H_crude_full = kp.build_H_of_k(all_bands=True)
+        >>> H_crude_setA = kp.build_H_of_k()
+        >>> E = bands.evaluate({'full': H_crude_full, 'setA': H_crude_setA,
+        ...                     'optimal': optimal.Heff})
+        >>> ax.plot(bands.kdist, E['optimal'], c='black')
+        """
+        results = {}
+        for name, H in models.items():
+            stored = self.results.get(name)
+            if (recompute or stored is None or stored[0] is not H
+                    or stored[1] != (window, indices) or (eigvecs and stored[3] is None)):
+                if window is not None or indices is not None:
+                    energies, vectors, _ = partial_spectrum(H, self.k3D, window, indices, 
+                                                            eigvecs, verbose=verbose)
+                else:
+                    Hk = stack_hamiltonians(H, self.k3D)
+                    if eigvecs:
+                        energies, vectors = eigh(Hk)
+                    else:
+                        energies, vectors = eigvalsh(Hk), None
+                stored = (H, (window, indices), energies, vectors)
+                self.results[name] = stored
+            results[name] = (stored[2], stored[3]) if eigvecs else stored[2]
+        return results
     
     def set_labels_and_limits(self, ax, xmin=None, xmax=None, ymin=None, ymax=None):
         """
@@ -157,6 +237,158 @@ class qe_plotter:
         ticklabels[-1].set_ha("right")
 
 
+def stack_hamiltonians(H, k):
+    '''
+    Builds the Hamiltonians of a model for all k points.
+
+    Parameters
+    ----------
+    H : callable
+        H(kx, ky, kz) for a single k point, optionally also accepting an
+        (Nk, 3) array of k points, as in lowdin.H_of_k(...).
+    k : array, shape (Nk, 3)
+        The k points.
+
+    Returns
+    -------
+    array, shape (Nk, N, N)
+        The stacked Hamiltonians.
+    '''
+    try:
+        Hk = asarray(H(k))
+        if Hk.ndim == 3 and len(Hk) == len(k):
+            return Hk
+    except (TypeError, ValueError):
+        pass
+    # H only takes a single k point
+    return array([H(*kvec) for kvec in k])
+
+def partial_spectrum(H, k, window=None, indices=None, eigvecs=False, margin=2, verbose=False):
+    '''
+    Calculates only the eigenpairs of H(k) inside an energy or index window,
+    for all k points along a path.
+
+    Parameters
+    ----------
+    H : callable
+        H(kx, ky, kz) for a single k point, e.g. the full crude model
+        built by irrep.build_H_of_k(all_bands=True).
+    k : array, shape (Nk, 3)
+        The k points, ordered along the path.
+    window : tuple (emin, emax), optional
+        Energy window in Ry. Only the eigenvalues inside it are returned.
+    indices : tuple (first, last), optional
+        Index window (inclusive, starting at 0). Only the eigenpairs
+        first, ..., last are returned. Give either window or indices.
+    eigvecs : bool, optional
+        If True, also returns the eigenvectors. Defaults to False.
+    margin : int, optional
+        Extra eigenpairs calculated at each side of the energy window,
+        see Notes. Defaults to 2.
+    verbose : bool, optional
+        If True, prints how much work the window saved.
+
+    Returns
+    -------
+    energies : array, shape (Nk, M)
+        The eigenvalues inside the window. Each column is a band, with
+        the band indices in stats['bands']. In the energy window mode the
+        bands may enter or leave the window along the path, and the
+        entries outside of it are NaN (which matplotlib does not plot).
+    vectors : array, shape (Nk, N, M) or None
+        The eigenvectors, if eigvecs is True.
+    stats : dict
+        'computed' eigenpairs, 'full' number of eigenpairs of the complete
+        solves, their ratio 'fraction', the number of 'retries', and the
+        indices of the 'bands' in the columns of energies.
+
+    Notes
+    -----
+    The eigenpairs are calculated by scipy.linalg.eigh with subset_by_index.
+    In the energy window mode, the first k point is solved completely to
+    find the indices of the window. Each following k point is then solved
+    only for the indices found at the previous one, plus margin at each
+    side. If the window is not fully covered, e.g. at a band crossing
+    the edge of the window, the margin is doubled and the k point is
+    solved again (a retry).
+
+    The reduction to the tridiagonal form is always done for the full
+    matrix, so the saving is in the eigenvalues and, mostly, in the
+    eigenvectors. It is largest with eigvecs=True.
+
+    Examples
+    --------
+    >>> H_crude_full = kp.build_H_of_k(all_bands=True)
+    >>> Efull, _, stats = partial_spectrum(H_crude_full, bands.k3D, window=(-1, 1))
+    >>> ax.plot(bands.kdist, Efull, c='gray')
+    '''
+    if (window is None) == (indices is None):
+        raise Exception('Inform either window or indices.')
+    energies, vectors, bands = [], [], []
+    computed = retries = 0
+    guess = None # index window found at the previous k point
+    for kvec in k:
+        Hk = H(*kvec)
+        N = len(Hk)
+        if indices is not None:
+            first, last = indices
+            e, u = _eigh_subset(Hk, first, last, eigvecs)
+            computed += last - first + 1
+            idx = arange(first, last+1)
+        else:
+            emin, emax = window
+            if guess is None:
+                first, last = 0, N-1
+            else:
+                first, last = max(guess[0]-margin, 0), min(guess[1]+margin, N-1)
+            extra = margin
+            while True:
+                e, u = _eigh_subset(Hk, first, last, eigvecs)
+                computed += last - first + 1
+                # the window is covered if the edges fall outside of it
+                if (first == 0 or e[0] < emin) and (last == N-1 or e[-1] > emax):
+                    break
+                retries += 1
+                extra = max(2*extra, 1)
+                if first > 0 and e[0] >= emin:
+                    first = max(first - extra, 0)
+                if last < N-1 and e[-1] <= emax:
+                    last = min(last + extra, N-1)
+            inside = (e >= emin) & (e <= emax)
+            idx = argwhere(inside)[:,0]
+            idx = first + idx
+            if len(idx) > 0:
+                guess = (idx[0], idx[-1])
+            e = e[inside]
+            u = u[:,inside] if eigvecs else None
+        energies.append(e)
+        vectors.append(u)
+        bands.append(idx)
+
+    # one column per band, NaN where the band is outside of the window
+    found = concatenate(bands)
+    lo, hi = (found.min(), found.max()) if len(found) > 0 else (0, -1)
+    E = full([len(k), hi-lo+1], nan)
+    U = full([len(k), N, hi-lo+1], nan, dtype=complex) if eigvecs else None
+    for i, e in enumerate(energies):
+        E[i,bands[i]-lo] = e
+        if eigvecs:
+            U[i,:,bands[i]-lo] = vectors[i].T
+
+    stats = {'computed': computed, 'full': len(k)*N, 
+             'fraction': computed/(len(k)*N), 'retries': retries,
+             'bands': arange(lo, hi+1)}
+    if verbose:
+        print(f"Partial spectrum: {computed} of {len(k)*N} eigenpairs "
+              f"({100*stats['fraction']:.1f}%), {retries} retries")
+    return E, U, stats
+
+def _eigh_subset(Hk, first, last, eigvecs):
+    # eigenpairs first, ..., last of Hk
+    if eigvecs:
+        return scipy_eigh(Hk, subset_by_index=[first, last])
+    return scipy_eigh(Hk, eigvals_only=True, subset_by_index=[first, last]), None
+
 def qe_bands_fix_units(dftdir, bandsgnu, kpath, kpt, alat, fermi):
     '''
     Reads bands in gnuplot format. The bands data is adjusted to set the Fermi 
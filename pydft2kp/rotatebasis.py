@@ -5,15 +5,16 @@ Module: **pydft2kp/rotatebasis.py**
 from numpy import array, allclose, trace, eye, kron, \
                   vstack, zeros, exp, diag, \
                   hstack, sum, abs, \
-                  append, ones, pi, argwhere
+                  append, ones, pi, argwhere, tensordot
 from numpy.linalg import norm
 from scipy.linalg import null_space, lstsq
-from scipy.optimize import minimize
-from sympy import lambdify
+from scipy.optimize import minimize, OptimizeResult
 from numpy.random import default_rng
 rng = default_rng()
 from .constants import QSkeys, DFTkeys
 from .util import convert_units_coeffs
+from .cache import as_checkpoint, hash_inputs
+from .lowdin import k_points, monomial_matrix, contract_monomials, monomial_key
 
 class basis_transform():
     '''
@@ -32,6 +33,10 @@ class basis_transform():
         Threshold for the null space calculation
     diagonal : bool
         If True, the U matrix enforces that H is diagonal at k=0.
+    checkpoint : str or None
+        Path of a checkpoint file (npz). The best U found so far is written
+        to it after each trial of findU(...), and a rerun with the same inputs
+        resumes from there instead of starting over. Defaults to None.
 
     Attributes
     ----------
@@ -56,9 +61,14 @@ class basis_transform():
         Label for the powers of k related to each coefficient.
     Heff : callable
         A function Heff(kx,ky,kz) for the effective Hamiltonian
-        as a function of k.
+        as a function of k. Also accepts an (Nk, 3) array of k points.
+    monomials : list
+        Keys of the monomials of the numeric model, e.g. [0, 'x', 'xx', ...]
+    Hmonomials : array
+        Matrices of the numeric model that multiply each monomial,
+        shape (nmonomials, N, N). See get_numeric_model(...).
     '''
-    def __init__(self, qsymm, irrep, nullspace_thresh=1e-4, diagonal=True):
+    def __init__(self, qsymm, irrep, nullspace_thresh=1e-4, diagonal=True, checkpoint=None):
         # match qsymm and irrep symmetries
         self.qs2irrep = self.match_qsymm_irrep(qsymm, irrep)
         
@@ -88,13 +98,32 @@ class basis_transform():
                   There might be symmetry constraints missing. Please check if you are using all symmetry group generators.')
 
         # minimize residues to find linear combination
-        # of the null space and get the optimized U
-        residue = 1
-        count = 0
+        # of the null space and keep the best U
+        checkpoint = as_checkpoint(checkpoint)
+        if checkpoint:
+            key = hash_inputs(self.Q, self.US, irrep.energies[irrep.setA], diagonal)
+            stored = checkpoint.load(key)
+        else:
+            stored = None
+        if stored is None:
+            self.report, self.U = None, None
+            residue = float('inf')
+            count = 0
+        else:
+            # resume from the best U of the previous run
+            residue = float(stored['residue'])
+            count = int(stored['count'])
+            self.report = OptimizeResult(x=stored['x'], fun=residue)
+            self.U = stored['U']
         while (residue > 1e-6) and (count < 50):
-            self.report, self.U = self.findU(qsymm, irrep, diagonal)
-            residue = self.report.fun
+            report, U = self.findU(qsymm, irrep, diagonal)
+            if report.fun < residue:
+                self.report, self.U = report, U
+                residue = report.fun
             count += 1
+            if checkpoint:
+                checkpoint.store(key, {'residue': residue, 'count': count, 
+                                       'x': self.report.x, 'U': self.U})
         if residue > 1e-6:
             raise Exception(f'WARNING: findU did not converge after {count} trials.')
 
@@ -413,15 +442,63 @@ class basis_transform():
             Label for the powers of k related to each coefficient.
         Heff : callable
             A function Heff(kx,ky,kz) for the effective Hamiltonian
-            as a function of k.
+            as a function of k. See get_numeric_model(...).
         '''
         coeffs, keys = self.get_coeffs(qsymm, irrep)
-        tosub = []
-        for n in range(len(coeffs)):
-            tosub += [('c'+str(n), coeffs[n])]
-        return coeffs, keys, lambdify(['k_x', 'k_y', 'k_z'], qsymm.Hmodel.subs(tosub))
+        self.monomials, self.Hmonomials = self.get_numeric_model(qsymm, coeffs)
+        return coeffs, keys, self.numeric_Heff(self.monomials, self.Hmonomials)
+
+    def get_numeric_model(self, qsymm, coeffs=None):
+        '''
+        Builds the numeric effective model, without sympy.
+
+        The matrices of each qsymm family are stacked per monomial of k
+        into a tensor F[n, m, :, :], see family_tensor(...), which is
+        contracted with the coefficients into the matrices
+        H[m] = sum_n coeffs[n] F[n, m] that multiply each monomial.
+
+        Parameters
+        ----------
+        qsymm : qsymm object
+            Model built with our qsymm class
+        coeffs : array, optional
+            Values of the cn coefficients. Defaults to self.coeffs.
+
+        Returns
+        -------
+        monomials : list
+            Keys of the monomials, as in irrep.Hdict, e.g. [0, 'x', 'xx', ...]
+        Hmonomials : array
+            The matrices that multiply each monomial, shape (nmonomials, N, N).
+        '''
+        if coeffs is None:
+            coeffs = self.coeffs
+        monomials, F = family_tensor(qsymm.model)
+        return monomials, tensordot(coeffs, F, axes=1)
+
+    def numeric_Heff(self, monomials, Hmonomials):
+        '''
+        Builds the callable Heff(kx, ky, kz) from the numeric model.
+
+        Parameters
+        ----------
+        monomials, Hmonomials :
+            The numeric model, from get_numeric_model(...).
+
+        Returns
+        -------
+        Heff : callable
+            Heff(kx, ky, kz) returns the (N, N) effective Hamiltonian.
+            If kx is an (Nk, 3) array of k points, Heff(k) returns the
+            stacked (Nk, N, N) Hamiltonians, see lowdin.H_of_k(...).
+        '''
+        def Heff(kx=0, ky=0, kz=0):
+            k, batched = k_points(kx, ky, kz)
+            h = contract_monomials(monomial_matrix(k, monomials), Hmonomials)
+            return h if batched else h[0]
+        return Heff
     
-    def get_coeffs(self, qsymm, irrep):
+    def get_coeffs(self, qsymm, irrep, Hdict=None):
         '''
         Compares the DFT data to the QSYMM model
         and extracts the numerical value for the coefficients cn.
@@ -432,15 +509,25 @@ class basis_transform():
             Model built with our qsymm class
         irrep : irrep object
             DFT data read by the irrep package
+        Hdict : dict, optional
+            Matrices that multiply the powers of momentum. Each entry may
+            also be a stack of matrices with shape (M, N, N), as returned by
+            lowdin.scan_remote_bands(...). Defaults to irrep.Hdict.
         
         Returns
         -------
         coeffs : array
             Values for each of the cn QSYMM model coefficients.
+            If Hdict is stacked, the shape is (M, ncoeffs).
         keys : array
             Label for the powers of k related to each coefficient.
         '''
+        if Hdict is None:
+            Hdict = irrep.Hdict
         N = len(self.U)
+        # DFT data rotated into the QSYMM basis, only for the keys
+        # used by the model, so a lazy Hdict only calculates these orders
+        Hrot = {}
         # compare DFT and QSYMM
         # builds and solve a system of equations
         equations = []
@@ -449,14 +536,16 @@ class basis_transform():
             for j in range(N):
                 for qsk, qek in zip(QSkeys, DFTkeys):
                     line = [q[qsk][i,j] for q in qsymm.model]
-                    Haux = self.U @ irrep.Hdict[qek] @ self.U.T.conj()
                     if not allclose(line, 0):
+                        if qek not in Hrot:
+                            Hrot[qek] = self.U @ Hdict[qek] @ self.U.T.conj()
                         equations += [line]
-                        values += [Haux[i,j]]
+                        values += [Hrot[qek][...,i,j]]
         equations = array(equations)
-        sol = lstsq(equations, values)
+        # stacked data is solved at once, one right-hand side per matrix
+        sol = lstsq(equations, array(values))
         # coeffs are real by construction
-        coeffs = sol[0].real
+        coeffs = sol[0].real.T
 
         # identify the labels of k-powers on each coefficient
         ncoeffs = len(qsymm.model)
@@ -464,7 +553,7 @@ class basis_transform():
         for n in range(ncoeffs):
             keys[n] = [] # init empty
         for qsk, qek in zip(QSkeys, DFTkeys):
-            if qek not in irrep.Hdict.keys():
+            if qek not in Hdict.keys():
                 continue
             for n in range(ncoeffs):
                 ij = argwhere(abs(qsymm.model[n][qsk]) > 1e-4)
@@ -488,3 +577,42 @@ class basis_transform():
             Coefficients with units converted to eV and nm.
         """
         return convert_units_coeffs(self.coeffs, self.keys, True, sigdigits)
+
+
+def family_tensor(family):
+    '''
+    Stacks the matrices of a qsymm family per monomial of k.
+
+    Parameters
+    ----------
+    family : list of qsymm Models
+        The family, e.g. qsymm.model from our qsymm class.
+
+    Returns
+    -------
+    monomials : list
+        Keys of the monomials present in the family, as in irrep.Hdict,
+        e.g. [0, 'x', 'xx', ...].
+    F : array
+        Tensor with shape (nfamily, nmonomials, N, N), where F[n, m] is
+        the matrix of family member n that multiplies monomial m.
+    '''
+    terms = []
+    for n, member in enumerate(family):
+        for key, matrix in member.items():
+            # exponents of k_x, k_y, k_z, e.g. k_x*k_y**2 -> [1, 2, 0]
+            exps = [0, 0, 0]
+            for symbol, power in key.as_powers_dict().items():
+                if str(symbol) in ('k_x', 'k_y', 'k_z'):
+                    exps['xyz'.index(str(symbol)[-1])] = int(power)
+            if hasattr(matrix, 'toarray'): # sparse_linalg=True
+                matrix = matrix.toarray()
+            terms += [(n, monomial_key(exps), matrix)]
+    # ordered by power, as the keys of irrep.Hdict
+    monomials = sorted({mkey for _, mkey, _ in terms}, 
+                       key=lambda m: (0, '') if m == 0 else (len(m), m))
+    N = terms[0][2].shape[0]
+    F = zeros([len(family), len(monomials), N, N], dtype=complex)
+    for n, mkey, matrix in terms:
+        F[n, monomials.index(mkey)] += matrix
+    return monomials, F
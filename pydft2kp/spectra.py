@@ -0,0 +1,360 @@
+'''
+Doc for the **pydft2kp/spectra.py** module.
+
+Density of states (DOS) and joint density of states (JDOS) of the kp
+models. The model is sampled on a k mesh in chunks, and each chunk is
+accumulated into histograms on a uniform energy grid, so the eigenpairs
+are never stored. The broadening is either Gaussian or by the linear
+tetrahedron method (triangles in 2D, segments in 1D). The chunks can be
+distributed over a process pool.
+
+The JDOS may be weighted by the momentum matrix elements
+:math:`|\\langle m|\\hat{e}\\cdot\\partial H/\\partial k|n\\rangle|^2`, which
+gives the interband absorption, :math:`\\varepsilon_2(\\omega) \\propto J_w(\\omega)/\\omega^2`.
+'''
+
+import os
+import numpy as np
+from itertools import permutations
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from .lowdin import monomial_matrix, contract_monomials, threadpool_limits
+from .derivatives import polynomial_model, monomial_derivatives
+from .mesh import kwedge
+
+def dos(model, mesh, energies, sigma=None, method='gaussian', bands=None, maxorder=2,
+        chunk=4096, n_workers=None):
+    '''
+    Calculates the density of states of a kp model.
+
+    Parameters
+    ----------
+    model : irrep, basis_transform or dict
+        The kp model, see derivatives.polynomial_model(...).
+    mesh : kmesh or kwedge
+        The k mesh. A kwedge (irreducible wedge) is only supported by the
+        Gaussian method, with the weights of its k points.
+    energies : array
+        Uniform energy grid, in Ry.
+    sigma : float, optional
+        Width of the Gaussian broadening, in Ry. Defaults to None, for a
+        plain histogram with the spacing of the energy grid.
+    method : str, optional
+        'gaussian' (default) or 'tetrahedron'.
+    bands : list of int, optional
+        Bands included. Defaults to all bands.
+    maxorder : int, optional
+        Highest power of k taken from Hdict. Defaults to 2.
+    chunk : int, optional
+        Number of k points diagonalized at once. Defaults to 4096.
+    n_workers : int, optional
+        Number of processes. Defaults to None (single process). Scripts
+        must protect their entry point with if __name__ == '__main__':.
+
+    Returns
+    -------
+    array
+        The DOS on the energy grid, in states per Ry per k point of the
+        mesh, so that it integrates to the number of bands. Multiply by the
+        number of k points over the volume of the k region, (2pi)^d/V,
+        to get the DOS per unit volume.
+
+    Examples
+    --------
+    >>> k = np.linspace(-0.1, 0.1, 101)
+    >>> w = np.linspace(-0.5, 0.5, 1001)
+    >>> D = dos(optimal, kmesh(k, k, k), w, method='tetrahedron')
+    '''
+    params = {'kind': 'dos', 'bands': bands}
+    return spectrum(model, mesh, energies, params, sigma, method, maxorder, chunk, n_workers)[0]
+
+def jdos(model, mesh, energies, valence, conduction=None, polarization=None, sigma=None,
+         method='gaussian', maxorder=2, chunk=4096, n_workers=None):
+    '''
+    Calculates the joint density of states of a kp model, and the JDOS
+    weighted by the momentum matrix elements.
+
+    Parameters
+    ----------
+    model, mesh, energies, sigma, method, maxorder, chunk, n_workers :
+        See dos(...).
+    valence : list of int
+        Indices of the initial (occupied) bands.
+    conduction : list of int, optional
+        Indices of the final (empty) bands. Defaults to all bands above
+        the valence bands.
+    polarization : array, optional
+        Polarization vector e of the light. Defaults to None, for the
+        average over x, y and z, which is required with a kwedge.
+
+    Returns
+    -------
+    J : array
+        The JDOS on the grid of transition energies.
+    Jw : array
+        The JDOS weighted by :math:`|\\langle m|\\hat{e}\\cdot\\partial H/\\partial k|n\\rangle|^2`,
+        in Ry² Bohr² (Ry.Bohr is the unit of the velocity, with hbar = 1).
+
+    Notes
+    -----
+    The matrix elements use the exact dH/dk of the polynomial model, see
+    derivatives.derivative_matrices(...). In the model basis this is
+    2p + 2k for the crude model.
+    '''
+    if polarization is not None and isinstance(mesh, kwedge):
+        raise Exception('Use polarization=None (average) with a kwedge.')
+    params = {'kind': 'jdos', 'valence': list(valence), 'conduction': conduction,
+              'polarization': polarization}
+    return spectrum(model, mesh, energies, params, sigma, method, maxorder, chunk, n_workers)
+
+def spectrum(model, mesh, energies, params, sigma=None, method='gaussian', maxorder=2,
+             chunk=4096, n_workers=None):
+    '''
+    Accumulates the histograms of dos(...) and jdos(...), chunk by chunk.
+
+    Returns
+    -------
+    hist, whist : arrays
+        The (broadened) histograms of the energies, without and with
+        the weights, normalized per k point of the mesh and per Ry.
+    '''
+    energies = np.asarray(energies, dtype=float)
+    dE = energies[1] - energies[0]
+    if not np.allclose(np.diff(energies), dE):
+        raise Exception('The energy grid must be uniform.')
+    if method not in ('gaussian', 'tetrahedron'):
+        raise Exception('Unknown broadening method: ' + str(method))
+    if method == 'tetrahedron' and isinstance(mesh, kwedge):
+        raise Exception('The tetrahedron method requires the full kmesh.')
+    edges = np.append(energies - dE/2, energies[-1] + dE/2)
+    keys, T = polynomial_model(model, maxorder)
+    state = {'mesh': mesh, 'keys': keys, 'T': T, 'edges': edges, 'params': params,
+             'method': method}
+
+    if method == 'gaussian':
+        tasks = [(start, stop) for start in range(0, mesh.size, chunk)
+                 for stop in [min(start + chunk, mesh.size)]]
+    else:
+        # slabs of cells along the first axis of the mesh with more than one point
+        a0 = [n > 1 for n in mesh.shape].index(True)
+        stride = int(np.prod(mesh.shape[a0+1:]))
+        step = max(1, chunk // stride)
+        tasks = [(i, min(i + step, mesh.shape[a0] - 1))
+                 for i in range(0, mesh.shape[a0] - 1, step)]
+
+    hist = np.zeros(len(energies))
+    whist = np.zeros(len(energies))
+    if n_workers is None or n_workers <= 1:
+        _spectra.update(state)
+        results = map(_histograms, tasks)
+        for h, w in results:
+            hist += h
+            whist += w
+    else:
+        blas_threads = max(1, (os.cpu_count() or 1)//n_workers)
+        with ProcessPoolExecutor(n_workers, mp_context=get_context('spawn'),
+                                 initializer=_spectra_init,
+                                 initargs=(state, blas_threads)) as pool:
+            for h, w in pool.map(_histograms, tasks):
+                hist += h
+                whist += w
+
+    # normalized per k point of the mesh and per Ry
+    hist /= mesh.mesh.size if isinstance(mesh, kwedge) else mesh.size
+    whist /= mesh.mesh.size if isinstance(mesh, kwedge) else mesh.size
+    if method == 'gaussian':
+        hist = broaden(hist, dE, sigma)
+        whist = broaden(whist, dE, sigma)
+    return hist / dE, whist / dE
+
+def broaden(hist, dE, sigma=None):
+    '''
+    Convolves a histogram with a normalized Gaussian of width sigma.
+    '''
+    if not sigma:
+        return hist
+    n = int(np.ceil(5*sigma/dE))
+    x = np.arange(-n, n+1) * dE
+    g = np.exp(-x**2/(2*sigma**2))
+    return np.convolve(hist, g/g.sum(), mode='same')
+
+# state of the processes (or of the single process) of spectrum(...)
+_spectra = {}
+
+def _spectra_init(state, blas_threads):
+    if threadpool_limits is not None:
+        _spectra['limits'] = threadpool_limits(blas_threads)
+    _spectra.update(state)
+
+def _sample(k):
+    # energies (Nk, nq) and weights (Nk, nq) of the states or transitions
+    keys, T, params = _spectra['keys'], _spectra['T'], _spectra['params']
+    H = contract_monomials(monomial_matrix(k, keys), T)
+    if params['kind'] == 'dos':
+        E = np.linalg.eigvalsh(H)
+        if params['bands'] is not None:
+            E = E[:,params['bands']]
+        return E, np.ones_like(E)
+    E, U = np.linalg.eigh(H)
+    v = params['valence']
+    c = params['conduction']
+    if c is None:
+        c = list(range(max(v) + 1, E.shape[1]))
+    dH = np.stack([contract_monomials(monomial_derivatives(k, keys, (i,)), T)
+                   for i in range(3)], axis=1)
+    # matrix elements <m|dH|n>, m in conduction, n in valence
+    P = U[:,None,:,c].conj().swapaxes(-1, -2) @ dH @ U[:,None,:,v]
+    if params['polarization'] is None:
+        W = np.sum(np.abs(P)**2, axis=1) / 3
+    else:
+        e = np.asarray(params['polarization'], dtype=complex)
+        e = e / np.linalg.norm(e)
+        W = np.abs(np.einsum('i,kimn->kmn', e.conj(), P))**2
+    dE = E[:,c][:,:,None] - E[:,v][:,None,:]
+    return dE.reshape(len(k), -1), W.reshape(len(k), -1)
+
+def _histograms(task):
+    mesh, edges = _spectra['mesh'], _spectra['edges']
+    if _spectra['method'] == 'gaussian':
+        start, stop = task
+        E, W = _sample(mesh.points(start, stop))
+        if isinstance(mesh, kwedge):
+            W = W * mesh.weights[start:stop,None]
+            weights = np.broadcast_to(mesh.weights[start:stop,None], E.shape)
+        else:
+            weights = None
+        h = np.histogram(E, edges, weights=weights)[0]
+        w = np.histogram(E, edges, weights=W)[0]
+        return h.astype(float), w
+    return _simplex_histograms(*task)
+
+def _simplex_histograms(i0, i1):
+    # linear tetrahedron method on the cells i0, ..., i1-1 along the first active axis
+    mesh, edges = _spectra['mesh'], _spectra['edges']
+    active = [c for c in range(3) if mesh.shape[c] > 1]
+    d = len(active)
+    a0 = active[0]
+    stride = int(np.prod(mesh.shape[a0+1:]))
+    E, W = _sample(mesh.points(i0*stride, (i1+1)*stride))
+    grid = (i1 - i0 + 1,) + tuple(mesh.shape[c] for c in active[1:])
+    nq = E.shape[1]
+    E = E.reshape(grid + (nq,))
+    W = W.reshape(grid + (nq,))
+    ncells = np.prod([mesh.shape[c] - 1 for c in active])
+    # corners of the cells, and the d! simplices of each cell
+    def corner(offset):
+        return tuple(slice(o, n-1+o) for o, n in zip(offset, grid))
+    h = np.zeros(len(edges) - 1)
+    w = np.zeros(len(edges) - 1)
+    for perm in permutations(range(d)):
+        offset = [0]*d
+        vertices = [tuple(offset)]
+        for axis in perm:
+            offset[axis] = 1
+            vertices.append(tuple(offset))
+        Ev = np.stack([E[corner(v)] for v in vertices], axis=-1).reshape(-1, d+1)
+        Wv = np.stack([W[corner(v)] for v in vertices], axis=-1).reshape(-1, d+1).mean(axis=1)
+        S, Sw = simplex_sums(Ev, edges, Wv)
+        h += np.diff(S)
+        w += np.diff(Sw)
+    volume = 1/(np.prod(range(1, d+1)) * ncells)
+    # per k point of the mesh, as in the gaussian method
+    return h * volume * mesh.size, w * volume * mesh.size
+
+def simplex_idos(e, edges):
+    '''
+    Integrated DOS of linear simplices (segments, triangles or tetrahedra).
+
+    Parameters
+    ----------
+    e : array
+        Energies at the vertices, shape (M, d+1) with d = 1, 2 or 3.
+    edges : array
+        Energies where the integrated DOS is evaluated.
+
+    Returns
+    -------
+    array
+        Fraction of the volume of each simplex with energy below each
+        edge, shape (M, len(edges)).
+    '''
+    return _idos(_lift(e), np.asarray(edges)[None,:])
+
+def simplex_sums(e, edges, weights):
+    '''
+    Sums of the integrated DOS of linear simplices at each edge.
+
+    Only the edges between the lowest and highest energies of each simplex
+    are evaluated, and the simplices below an edge add 1 to it, so the cost
+    scales with the number of simplices plus the number of edges they span,
+    instead of their product as in simplex_idos(...).
+
+    Parameters
+    ----------
+    e : array
+        Energies at the vertices, shape (M, d+1) with d = 1, 2 or 3.
+    edges : array
+        Sorted energies where the integrated DOS is evaluated.
+    weights : array
+        Weight of each simplex, shape (M,).
+
+    Returns
+    -------
+    S, Sw : arrays
+        The sums of simplex_idos(e, edges) over the simplices, without and
+        with the weights, shape (len(edges),).
+    '''
+    e = _lift(e)
+    K = len(edges)
+    # edges strictly inside each simplex: lo, ..., hi-1; from hi on, the idos is 1
+    lo = np.searchsorted(edges, e[:,0], side='right')
+    hi = np.searchsorted(edges, e[:,-1], side='left')
+    S = np.cumsum(np.bincount(hi, minlength=K+1)[:K]).astype(float)
+    Sw = np.cumsum(np.bincount(hi, weights, minlength=K+1)[:K])
+    # pairs (simplex, edge) inside, in blocks of bounded memory
+    counts = np.maximum(hi - lo, 0)
+    ends = np.cumsum(counts)
+    block = 2**22
+    start = 0
+    while start < len(e):
+        stop = max(np.searchsorted(ends, ends[start] - counts[start] + block, side='right'), start+1)
+        c = counts[start:stop]
+        s = np.repeat(np.arange(start, stop), c)
+        j = np.arange(c.sum()) - np.repeat(np.cumsum(c) - c, c) + np.repeat(lo[start:stop], c)
+        n = _idos(e[s], edges[j][:,None])[:,0]
+        S += np.bincount(j, n, minlength=K)
+        Sw += np.bincount(j, weights[s]*n, minlength=K)
+        start = stop
+    return S, Sw
+
+def _lift(e):
+    # sorted vertex energies, with exact degeneracies lifted, 
+    # which would give zero denominators
+    d = e.shape[1] - 1
+    e = np.sort(e, axis=1)
+    scale = np.abs(e).max() + 1
+    return e + 1e-10*scale*np.arange(d+1)
+
+def _idos(e, x):
+    # integrated DOS of the sorted simplices e at the energies x
+    d = e.shape[1] - 1
+    if d == 1:
+        e1, e2 = [e[:,[i]] for i in range(2)]
+        return np.clip((x - e1)/(e2 - e1), 0, 1)
+    if d == 2:
+        e1, e2, e3 = [e[:,[i]] for i in range(3)]
+        lower = (x - e1)**2/((e2 - e1)*(e3 - e1))
+        upper = 1 - (e3 - x)**2/((e3 - e1)*(e3 - e2))
+        n = np.where(x >= e1, lower, 0)
+        n = np.where(x >= e2, upper, n)
+        return np.where(x >= e3, 1, n)
+    e1, e2, e3, e4 = [e[:,[i]] for i in range(4)]
+    lower = (x - e1)**3/((e2 - e1)*(e3 - e1)*(e4 - e1))
+    y = x - e2
+    middle = ((e2 - e1)**2 + 3*(e2 - e1)*y + 3*y**2
+              - (e3 - e1 + e4 - e2)/((e3 - e2)*(e4 - e2))*y**3)/((e3 - e1)*(e4 - e1))
+    upper = 1 - (e4 - x)**3/((e4 - e1)*(e4 - e2)*(e4 - e3))
+    n = np.where(x >= e1, lower, 0)
+    n = np.where(x >= e2, middle, n)
+    n = np.where(x >= e3, upper, n)
+    return np.where(x >= e4, 1, n)
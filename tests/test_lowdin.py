@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+
+from pydft2kp.lowdin import (lowdin, prepare_blocks, order2, order3, order4,
+                             order2_tensor, order3_tensor, order4_tensor,
+                             tensor_to_monomials, scan_remote_bands)
+
+def reference(order, A, B, e0, V):
+    # tensor h[i,...,a,a1] from the element-wise functions
+    n = len(V)
+    NA = len(A)
+    h = np.zeros((n,)*order + (NA, NA), dtype=complex)
+    for word in np.ndindex(h.shape[:order]):
+        Hs = [V[i] for i in word]
+        for ia, a in enumerate(A):
+            for ja, a1 in enumerate(A):
+                if order == 2:
+                    h[word][ia,ja] = order2(a, a1, B, e0, *Hs)
+                elif order == 3:
+                    h[word][ia,ja] = order3(a, a1, A, B, e0, *Hs)
+                else:
+                    h[word][ia,ja] = order4(a, a1, A, B, e0, *Hs)
+    return h
+
+@pytest.fixture(params=[None, 3], ids=['NB=None', 'NB=3'])
+def system(request):
+    # random Hermitian perturbations on 9 non-degenerate bands
+    rng = np.random.default_rng(7)
+    N = 9
+    H0 = np.diag(np.sort(rng.uniform(-3, 3, N)))
+    def hermitian():
+        X = 0.2*(rng.normal(size=(N, N)) + 1j*rng.normal(size=(N, N)))
+        return X + X.conj().T
+    A = np.array([3, 4])
+    return A, H0, np.array([hermitian() for _ in range(3)]), request.param
+
+@pytest.mark.parametrize('order, tensor', [(2, order2_tensor), (3, order3_tensor), 
+                                           (4, order4_tensor)])
+def test_order_tensors(system, order, tensor):
+    A, H0, V, NB = system
+    B, e0, V, D, VAA, VAB, VBA, VBB = prepare_blocks(A, H0, V, NB)
+    if order == 2:
+        h = tensor(D, VAB, VBA)
+    else:
+        h = tensor(D, VAA, VAB, VBA, VBB)
+    assert np.allclose(h, reference(order, A, B, e0, V), atol=1e-12)
+
+def test_lowdin(system):
+    A, H0, V, NB = system
+    h = lowdin(A, H0, *V, NB=NB, maxorder=4)
+    B, e0 = prepare_blocks(A, H0, V, NB)[:2]
+    expected = {0: H0[A,:][:,A]}
+    expected.update(tensor_to_monomials(V[:,A][:,:,A]))
+    for order in [2, 3, 4]:
+        expected.update(tensor_to_monomials(reference(order, A, B, e0, V)))
+    # k² from H = H0 + 2k.p + k²
+    for c in 'xyz':
+        expected[c+c] = expected[c+c] + np.eye(len(A))
+    assert set(h) == set(expected)
+    for key in h:
+        assert np.allclose(h[key], expected[key], atol=1e-12), key
+
+def test_scan_remote_bands(system):
+    A, H0, V, _ = system
+    NBs = [0, 2, 4]
+    scan = scan_remote_bands(A, H0, *V, NBs)
+    for i, NB in enumerate(NBs):
+        h = lowdin(A, H0, *V, NB=NB, maxorder=2)
+        for key in h:
+            assert np.allclose(scan[key][i], h[key], atol=1e-12), (NB, key)